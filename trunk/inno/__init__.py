@@ -1,5 +1,6 @@
 import inno.runner
 build = inno.runner.build
+buildMany = inno.runner.buildMany
 from inno.script import Script, PythonScript
 
-__all__ = ('build', 'Script', 'PythonScript', )
+__all__ = ('build', 'buildMany', 'Script', 'PythonScript', )
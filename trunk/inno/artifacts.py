@@ -0,0 +1,183 @@
+"""A cache of built installers shared between machines.
+
+Builders that point an ArtifactCache at the same directory, such as a
+mounted volume, build each installer once: the first to build it
+publishes it under a key made from everything that went into it, and
+the others fetch it from there.  A fetch copies the installer, or with
+link=1 makes a hard link to it where the filesystem allows.  Installers
+in the cache are read-only, as a linked one is the cache's own copy and
+writing to it in place would change it for every builder.
+
+Nothing is ever locked.  An installer is copied to a temporary file
+first and then renamed into place, so a reader sees all of it or none,
+and two builders publishing the same key just both rename.  Fetching
+records the use by touching a .used file beside the installer, and once
+the cache holds more than maxBytes the least recently used installers
+are removed.  A fetch that loses a race with the removal is a miss.
+
+The key is a digest of the .iss, the contents of the compiler and the
+size and contents of every source, with the working directory taken out
+of all paths, so that builders checked out in different places, with the
+compiler installed in different places, share installers too.
+"""
+import os
+import time
+import shutil
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from inno.atomicfile import writeFile, linkFile
+
+# the default limit on the size of a cache
+MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# temporary files older than this were left behind by a builder that died
+STALE_SECONDS = 24 * 60 * 60
+
+SUFFIX = '.exe'
+
+
+def artifactKey(script, compiler, fingerprints, workdir):
+    """The key of the installer built from the .iss text script with
+    compiler, as runner.compilerDigest() describes it, from sources with
+    fingerprints, a {source: (size, mtime, digest)} dictionary as
+    inno.buildstate keeps it, or None if a source has no digest.  Paths
+    under workdir are made relative to it.
+    """
+    prefix = os.path.join(workdir, '')
+    def local(text):
+        return text.replace(prefix, '{workdir}' + os.sep).replace(
+            workdir, '{workdir}')
+    sources = []
+    for src, (size, mtime, digest) in fingerprints.iteritems():
+        if digest is None:
+            return None
+        sources.append((local(src), size, digest))
+    sources.sort()
+    return sha1(repr((local(script), local(repr(compiler)),
+                      sources))).hexdigest()
+
+
+def _copier(src):
+    """A writer for inno.atomicfile.writeFile() that copies src"""
+    def copy(f):
+        s = open(src, 'rb')
+        try:
+            shutil.copyfileobj(s, f)
+        finally:
+            s.close()
+    return copy
+
+
+def _remove(path):
+    """Remove path, read-only or not, if it is there"""
+    try:
+        os.remove(path)
+    except OSError:
+        # win32 will not remove a read-only file
+        try:
+            os.chmod(path, 0644)
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ArtifactCache:
+    """Installers filed by key in directory, at most maxBytes of them"""
+    def __init__(self, directory, maxBytes=MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def _touch(self, key):
+        used = self._path(key) + '.used'
+        try:
+            os.utime(used, None)
+        except OSError:
+            try:
+                open(used, 'w').close()
+            except IOError:
+                pass
+
+    def fetch(self, key, dest, link=0):
+        """Put a copy of the installer filed under key at dest, replacing
+        whatever is there, or with link a hard link to it where that can
+        be made.  A linked installer is read-only and must not be changed.
+        Returns whether there was one.
+        """
+        src = self._path(key)
+        if not os.path.exists(src):
+            return 0
+        try:
+            linked = 0
+            if link:
+                try:
+                    linkFile(src, dest)
+                    linked = 1
+                except (AttributeError, OSError):
+                    pass
+            if not linked:
+                writeFile(dest, _copier(src))
+        except (IOError, OSError):
+            return 0 # removed under our feet
+        self._touch(key)
+        return 1
+
+    def publish(self, key, filename):
+        """File a copy of the installer filename under key"""
+        final = self._path(key)
+        if os.path.exists(final):
+            self._touch(key)
+            return
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        try:
+            writeFile(final, _copier(filename), 0444)
+        except OSError:
+            if not os.path.exists(final):
+                raise
+            # somebody else published it first, and it is in use
+        self._touch(key)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used installers until the rest fit
+        in maxBytes, and any stale temporary files
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            p = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.tmp'):
+                    if os.stat(p).st_mtime < now - STALE_SECONDS:
+                        os.remove(p)
+                    continue
+                if not name.endswith(SUFFIX):
+                    continue
+                st = os.stat(p)
+                try:
+                    used = os.stat(p + '.used').st_mtime
+                except OSError:
+                    used = st.st_mtime
+            except OSError:
+                continue # removed by somebody else meanwhile
+            entries.append((used, name, st.st_size))
+            total = total + st.st_size
+        entries.sort()
+        for used, name, size in entries:
+            if total <= self.maxBytes:
+                break
+            p = os.path.join(self.directory, name)
+            _remove(p)
+            _remove(p + '.used')
+            total = total - size
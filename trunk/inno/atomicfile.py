@@ -0,0 +1,88 @@
+"""Replacing files so that a reader sees the old one or the new one whole.
+
+The new contents go to a temporary file with a name nobody else is
+using, in the same directory as the file it replaces, which is then
+renamed over it.  Where rename replaces (everywhere but win32) that is
+atomic.  On win32 the old file is removed first, and for that moment a
+reader finds no file at all, which every cache here takes as empty.
+"""
+import os
+import sys
+import errno
+import tempfile
+
+TEMP_SUFFIX = '.tmp'
+
+
+def tempFile(filename):
+    """Create a temporary file to become filename, returning (fd, name)
+    as tempfile.mkstemp() does
+    """
+    directory, base = os.path.split(os.path.abspath(filename))
+    return tempfile.mkstemp(prefix=base + '.', suffix=TEMP_SUFFIX,
+                            dir=directory)
+
+
+def isTemp(name, filename):
+    """Whether name, a name in filename's directory, may be a temporary
+    file made by tempFile(filename)
+    """
+    base = os.path.basename(filename)
+    return name.startswith(base + '.') and name.endswith(TEMP_SUFFIX)
+
+
+def replaceFile(tmp, filename):
+    """Rename tmp to filename, replacing any file there"""
+    try:
+        os.rename(tmp, filename)
+        return
+    except OSError, e:
+        if sys.platform != 'win32' or e.errno != errno.EEXIST:
+            raise
+    # rename cannot replace on win32
+    try:
+        os.remove(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    os.rename(tmp, filename)
+
+
+def _discard(tmp):
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+
+
+def writeFile(filename, write, mode=0644):
+    """Call write with a file open for writing in binary mode, then make
+    what it wrote, with permissions mode, the contents of filename
+    """
+    fd, tmp = tempFile(filename)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            write(f)
+        finally:
+            f.close()
+        os.chmod(tmp, mode)
+        replaceFile(tmp, filename)
+    except:
+        _discard(tmp)
+        raise
+
+
+def linkFile(src, filename):
+    """Make filename a hard link to src, replacing any file there.
+    Raises OSError, or AttributeError where os has no link().
+    """
+    fd, tmp = tempFile(filename)
+    os.close(fd)
+    os.remove(tmp) # only the unique name is wanted
+    os.link(src, tmp)
+    try:
+        replaceFile(tmp, filename)
+    except:
+        _discard(tmp)
+        raise
@@ -0,0 +1,159 @@
+"""Remember what an installer was built from, to skip building it again.
+
+A BuildState file records, for the last successful build of a Script,
+a digest of the generated .iss, the identity of the compiler, a
+fingerprint of every source file, and the size and mtime of the
+installer.  If all of them still match, the installer is up to date and
+ISCC need not run.
+
+A source's fingerprint is its size and mtime.  With contentHash it has
+a digest of the file's contents too, and a file whose mtime moved but
+whose size and contents did not counts as unchanged, as after a fresh
+checkout.
+"""
+import os
+import cPickle
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from inno.dirwalk import FILE
+from inno.dedupe import fileDigest
+from inno.atomicfile import writeFile
+
+MAGIC = 'buildstate 1'
+
+
+def _same(fp, old):
+    """Whether a source with fingerprint fp is unchanged since it had old"""
+    if old is None:
+        return 0
+    if fp[:2] == old[:2]:
+        return 1
+    return fp[2] is not None and fp[0] == old[0] and fp[2] == old[2]
+
+
+class BuildReport:
+    """Whether the last check found the installer up to date (hit), and
+    if not, why not: reasons, and the sources that changed.  fetched says
+    the installer came from an inno.artifacts.ArtifactCache instead of
+    being built.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.hit = 0
+        self.fetched = 0
+        self.reasons = []
+        self.changed = []
+
+    def __str__(self):
+        if self.hit:
+            return "%s is up to date" % self.output
+        if self.fetched:
+            what = "fetched %s from the artifact cache"
+        else:
+            what = "built %s"
+        return (what + ": %s") % (self.output, '; '.join(self.reasons))
+
+
+class BuildState:
+    """The state of the last build, kept in filename"""
+    def __init__(self, filename, contentHash=0):
+        self.filename = filename
+        self.contentHash = contentHash
+        self.state = self.load()
+        self.new = None
+
+    def load(self):
+        """The stored state, or None if there is none that can be read"""
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                if f.readline().rstrip() != MAGIC:
+                    return None
+                return cPickle.load(f)
+            except Exception:
+                return None
+        finally:
+            f.close()
+
+    def save(self):
+        """Record the state check() found, as that of a successful build,
+        replacing the file only once the new one is complete
+        """
+        state = self.new
+        try:
+            st = os.stat(state['output'])
+            state['stamp'] = (st.st_size, st.st_mtime)
+        except OSError:
+            state['stamp'] = None
+        def write(f):
+            f.write('%s\n' % MAGIC)
+            cPickle.dump(state, f, 2)
+        writeFile(self.filename, write)
+        self.state = state
+
+    def _fingerprint(self, source, old):
+        """(size, mtime, digest) of the fmlang.Source source, whose last
+        fingerprint was old; the digest is None without contentHash
+        """
+        size, mtime = source.size, source.mtime
+        if not self.contentHash:
+            return size, mtime, None
+        if old is not None and old[:2] == (size, mtime) and old[2]:
+            return old
+        try:
+            digest = fileDigest(source.src)
+        except (IOError, OSError):
+            digest = None
+        return size, mtime, digest
+
+    def check(self, script, compiler, sources, output):
+        """Compare the build of the text script with compiler (anything
+        that changes when the compiler does) from sources, a list of
+        fmlang.Source records, into output, with the last one.  Returns a
+        BuildReport.
+        """
+        report = BuildReport(output)
+        old = self.state or {}
+        oldSources = old.get('sources', {})
+        fingerprints = {}
+        for s in sources:
+            if s.kind != FILE:
+                continue
+            fingerprints[s.src] = self._fingerprint(s, oldSources.get(s.src))
+        self.new = {'script': md5(script).hexdigest(),
+                    'compiler': compiler,
+                    'sources': fingerprints,
+                    'output': output}
+        if not old:
+            report.reasons.append('no previous build')
+            return report
+        if old['script'] != self.new['script']:
+            report.reasons.append('script changed')
+        if old['compiler'] != compiler:
+            report.reasons.append('compiler changed')
+        for src, fp in fingerprints.iteritems():
+            if not _same(fp, oldSources.get(src)):
+                report.changed.append(src)
+        for src in oldSources:
+            if src not in fingerprints:
+                report.changed.append(src)
+        if report.changed:
+            report.changed.sort()
+            report.reasons.append('%d sources changed' % len(report.changed))
+        try:
+            st = os.stat(output)
+            stamp = (st.st_size, st.st_mtime)
+        except OSError:
+            stamp = None
+        if old['output'] != output or stamp is None:
+            report.reasons.append('no installer')
+        elif old['stamp'] != stamp:
+            report.reasons.append('installer changed')
+        report.hit = not report.reasons
+        return report
@@ -0,0 +1,244 @@
+"""Find directory trees a manifest installs whole.
+
+A script collecting a big directory has one [Files] line per file, and
+ISCC takes a long time to read them all.  When everything under a source
+directory, all the way down, is installed under its own name at the same
+place below one destination directory, a single
+
+Source: "dir\\*"; DestDir: "{app}\\dest"; Flags: recursesubdirs
+
+does the same.  collapse() finds the largest such trees.  A tree with
+empty directories in it is only taken whole if the manifest installs
+all of them (the entry then gets createallsubdirs) or none.  Anything
+excluded, renamed, installed from elsewhere, or not a plain file or
+directory keeps the directory it is in, and those above it, out.
+
+ISCC expands the wildcard when it compiles, not when the manifest was
+made, so a Subtree remembers the mtime and the names of each directory
+in it, and changed() tells which have moved since.  Directories the
+build itself writes into should be passed to collapse() to avoid.
+"""
+import os
+import time
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from inno.dirwalk import DirWalker, FILE, DIR, RACY_SECONDS
+
+
+def _digest(names):
+    """A digest of a directory's names, in any order"""
+    names = list(names)
+    names.sort()
+    return md5('\0'.join(names)).digest()
+
+
+class Subtree:
+    """A source directory installed whole at dest; files is the number
+    of files in it, createAll whether its empty directories are wanted
+    """
+    def __init__(self, src, dest, files, createAll):
+        self.src = src
+        self.dest = dest
+        self.files = files
+        self.createAll = createAll
+        self.stamps = {} # {source directory: (mtime, digest of names)}
+        self.when = time.time()
+
+    def __repr__(self):
+        return "<Subtree %r %r>" % (self.src, self.dest)
+
+    def pattern(self):
+        """The Source of the [Files] entry"""
+        return os.path.join(self.src, '*')
+
+    def flags(self):
+        if self.createAll:
+            return 'recursesubdirs createallsubdirs'
+        return 'recursesubdirs'
+
+    def changed(self):
+        """The directories in the tree that no longer hold what they did
+        when it was collapsed
+        """
+        changed = []
+        for d, (mtime, digest) in self.stamps.items():
+            try:
+                # names are compared where the mtime is too recent to tell
+                if (os.stat(d).st_mtime != mtime or
+                    (mtime > self.when - RACY_SECONDS and
+                     _digest(os.listdir(d)) != digest)):
+                    changed.append(d)
+            except OSError:
+                changed.append(d)
+        return changed
+
+
+class CollapseReport:
+    """What collapse() did: subtrees is the list of Subtrees, before and
+    after the number of [Files] and [Dirs] lines without and with them
+    """
+    def __init__(self):
+        self.subtrees = []
+        self.before = 0
+        self.after = 0
+
+    def __str__(self):
+        return ("%d [Files] and [Dirs] lines instead of %d, with %d "
+                "directory trees installed by wildcard" % (
+                    self.after, self.before, len(self.subtrees)))
+
+
+class _Scan:
+    """What is under one source directory, if it is installed whole"""
+    def __init__(self):
+        self.own = []      # the sources directly in it
+        self.subdirs = []  # (source, destination) of its directories
+        self.files = 0
+        self.emptyWanted = 0   # an empty directory has a source
+        self.emptyUnwanted = 0 # an empty directory has none
+        self.stamp = None      # (mtime, digest of names) when listed
+
+
+def _split(dest):
+    """(directory, name) of a destination; a directory destination ends
+    with a separator
+    """
+    if dest[-1:] in (os.sep, os.altsep):
+        dest = dest[:-1]
+    return os.path.split(dest)
+
+
+def _mtime(walker, dirpath):
+    """The mtime dirpath had when walker read it, if walker kept it, else
+    the one it has now
+    """
+    if walker.mtimes is not None and dirpath in walker.mtimes:
+        return walker.mtimes[dirpath]
+    return os.stat(dirpath).st_mtime
+
+
+def collapse(sources, walker=None, avoid=()):
+    """Given fmlang.Source records, return ({destination: Subtree} for
+    every destination a Subtree installs, and a CollapseReport).  The
+    directories looked at are read through walker, a DirWalker, so a
+    walker that made the manifest has them already.  No Subtree holds
+    any of the directories in avoid.
+    """
+    if walker is None:
+        walker = DirWalker()
+    normcase = os.path.normcase
+    avoid = dict([(normcase(os.path.abspath(d)), 1) for d in avoid])
+    # source directory: {name: [(destination directory, Source)]}, for
+    # sources installed under their own names
+    children = {}
+    dirSources = {} # (source, destination directory): Source
+    for s in sources:
+        if s.kind not in (FILE, DIR):
+            continue
+        srcdir, name = os.path.split(s.src)
+        destdir, destname = _split(s.dest)
+        if s.kind == DIR:
+            dirSources[(s.src, os.path.join(destdir, destname))] = s
+        if name and destname == name:
+            children.setdefault(srcdir, {}).setdefault(name, []).append(
+                (destdir, s))
+    scans = {}
+
+    def scan(srcdir, destdir):
+        """The _Scan of srcdir installed at destdir, or None if it is not
+        installed whole there
+        """
+        key = (srcdir, destdir)
+        if key in scans:
+            return scans[key]
+        scans[key] = None # not whole, if we come round again
+        if normcase(srcdir) in avoid:
+            return None
+        try:
+            entries = walker.listdir(srcdir)
+            mtime = _mtime(walker, srcdir)
+        except OSError:
+            return None
+        mine = children.get(srcdir, {})
+        result = _Scan()
+        result.stamp = (mtime, _digest([e.name for e in entries]))
+        for e in entries:
+            kind = e.kind()
+            got = [s for d, s in mine.get(e.name, ()) if d == destdir]
+            if got and got[0].kind != kind:
+                return None
+            if kind == FILE:
+                if not got:
+                    return None
+                result.own.append(got[0])
+                result.files = result.files + 1
+            elif kind == DIR:
+                subdest = os.path.join(destdir, e.name)
+                sub = scan(e.path, subdest)
+                if sub is None:
+                    return None
+                result.subdirs.append((e.path, subdest))
+                result.files = result.files + sub.files
+                result.emptyWanted = result.emptyWanted or sub.emptyWanted
+                result.emptyUnwanted = (result.emptyUnwanted or
+                                        sub.emptyUnwanted)
+                if got:
+                    result.own.append(got[0])
+                if not sub.files:
+                    if got:
+                        result.emptyWanted = 1
+                    else:
+                        result.emptyUnwanted = 1
+            else:
+                return None
+        scans[key] = result
+        return result
+
+    def whole(srcdir, destdir):
+        """Whether srcdir can be installed at destdir by one entry"""
+        result = scan(srcdir, destdir)
+        return (result is not None and result.files > 0 and
+                not (result.emptyWanted and result.emptyUnwanted))
+
+    covered = {}
+    report = CollapseReport()
+    tops = []
+    for srcdir, names in children.items():
+        destdirs = {}
+        for pairs in names.values():
+            for destdir, s in pairs:
+                destdirs[destdir] = 1
+        for destdir in destdirs:
+            if not whole(srcdir, destdir):
+                continue
+            parent, name = os.path.split(srcdir)
+            updest, upname = os.path.split(destdir)
+            if (name and upname == name and parent in children
+                and whole(parent, updest)):
+                continue # the parent goes whole
+            tops.append((srcdir, destdir))
+    tops.sort()
+    for srcdir, destdir in tops:
+        result = scans[(srcdir, destdir)]
+        tree = Subtree(srcdir, destdir, result.files, result.emptyWanted)
+        report.subtrees.append(tree)
+        # the entry makes destdir too, as it has files to put there
+        top = dirSources.get((srcdir, destdir))
+        if top is not None:
+            covered[top.dest] = tree
+        todo = [(srcdir, destdir)]
+        while todo:
+            key = todo.pop()
+            result = scans[key]
+            tree.stamps[key[0]] = result.stamp
+            for s in result.own:
+                covered[s.dest] = tree
+            todo.extend(result.subdirs)
+    for s in sources:
+        if s.kind in (FILE, DIR):
+            report.before = report.before + 1
+    report.after = report.before - len(covered) + len(report.subtrees)
+    return covered, report
@@ -0,0 +1,126 @@
+"""Find files with identical contents in a manifest.
+
+ISCC stores a source file only once however many [Files] entries name
+it, but two identical files under different names are read and
+compressed twice.  dedupe() points every copy at one canonical source,
+so each distinct content goes into the installer once.  Only files of
+equal size are hashed, in the threads of a WorkerPool; files with equal
+hashes are compared byte for byte before being merged.
+"""
+import os
+import stat
+import filecmp
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from inno.workers import WorkerPool
+
+# bytes per second ISCC compresses, for estimating the time saved
+COMPRESS_RATE = 2 * 1024 * 1024
+
+
+def fileDigest(filename, blocksize=65536):
+    """The sha1 hex digest of the contents of filename"""
+    h = sha1()
+    f = open(filename, 'rb')
+    try:
+        while 1:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+class DedupeReport:
+    """What dedupe() merged: groups is a list of (canonical source, [other
+    sources], size)
+    """
+    def __init__(self):
+        self.groups = []
+
+    def files(self):
+        """How many sources now share another's contents"""
+        return sum([len(others) for canonical, others, size in self.groups])
+
+    def bytesSaved(self):
+        return sum([len(others) * size
+                    for canonical, others, size in self.groups])
+
+    def secondsSaved(self, rate=COMPRESS_RATE):
+        """A rough guess at the compile time saved, at rate bytes/s"""
+        return float(self.bytesSaved()) / rate
+
+    def __str__(self):
+        return ("%d duplicate files in %d groups: %d bytes not compressed "
+                "again, about %.1fs of compile time" % (
+                    self.files(), len(self.groups), self.bytesSaved(),
+                    self.secondsSaved()))
+
+
+def findDuplicates(sources, workers=4):
+    """Return [[source, ...], ...], the groups of files in sources with
+    the same contents, each in the order of sources.  Sources that are
+    not regular files are left out.
+    """
+    bySize = {}
+    order = {}
+    for src in sources:
+        if src in order:
+            continue
+        try:
+            st = os.stat(src)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        order[src] = len(order)
+        bySize.setdefault(st.st_size, []).append((src, st))
+    candidates = []
+    for size, files in bySize.items():
+        if len(files) > 1:
+            candidates.extend(files)
+    # links to one file are the same without reading it
+    byFile = {}
+    for src, st in candidates:
+        byFile.setdefault((st.st_dev, st.st_ino, st.st_size), []).append(src)
+    firsts = [srcs[0] for srcs in byFile.values()]
+    if workers > 1:
+        digests = WorkerPool(workers).map(fileDigest, firsts)
+    else:
+        digests = map(fileDigest, firsts)
+    byDigest = {}
+    for (key, srcs), digest in zip(byFile.items(), digests):
+        byDigest.setdefault((key[2], digest), []).append(srcs)
+    groups = []
+    for (size, digest), linked in byDigest.items():
+        srcs = []
+        for same in linked:
+            if srcs and not filecmp.cmp(srcs[0], same[0], shallow=0):
+                continue # a hash collision; leave it be
+            srcs.extend(same)
+        if len(srcs) > 1:
+            srcs.sort(lambda a, b: cmp(order[a], order[b]))
+            groups.append(srcs)
+    groups.sort(lambda a, b: cmp(order[a[0]], order[b[0]]))
+    return groups
+
+
+def dedupe(items, workers=4):
+    """Given (destination, source) items, return the items with the source
+    of every file replaced by the first source with the same contents,
+    and a DedupeReport
+    """
+    items = list(items)
+    groups = findDuplicates([src for dest, src in items], workers)
+    canonical = {}
+    report = DedupeReport()
+    for srcs in groups:
+        for src in srcs[1:]:
+            canonical[src] = srcs[0]
+        report.groups.append((srcs[0], srcs[1:], os.path.getsize(srcs[0])))
+    return [(dest, canonical.get(src, src)) for dest, src in items], report
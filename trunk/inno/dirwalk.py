@@ -0,0 +1,351 @@
+"""Directory traversal for the File-Mapper language.
+
+A DirWalker reads each directory once and hands out DirEntry objects that
+remember what kind of thing they name, so a glob walk never asks the
+filesystem about the same entry twice.  When os.scandir (or the scandir
+backport) is importable the kind usually comes straight from the directory
+read; otherwise each entry costs exactly one stat, and only if somebody
+asks for its kind.  Given a WorkerPool, a walker can also read directories
+it is about to need in other threads, which pays off where every read is
+a network round trip.  A single name can also be looked up without
+reading its directory at all.  A StreamingWalker keeps nothing once the
+walk has moved past it, for trees too big to remember.
+"""
+import os
+import sys
+import stat
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# entry kinds.  OTHER covers broken links, devices and the like, which
+# os.path.isdir and os.path.isfile both say no to.
+FILE = 'file'
+DIR = 'dir'
+OTHER = 'other'
+
+# whether one lstat can stand in for reading a directory to find a name in
+# it.  Not where names are compared without regard to case, or asking for
+# 'readme' could turn up 'README' under the wrong name.
+EXACT_NAMES = (os.path.normcase('A') == 'A' and
+               sys.platform not in ('darwin', 'cygwin'))
+
+# mtimes are kept to a second or two, so a directory changed this close
+# to being read may change again without its mtime moving.  What was read
+# from it cannot be trusted by its mtime alone.
+RACY_SECONDS = 2
+
+
+class WalkStats:
+    """Counters kept by a DirWalker"""
+    def __init__(self):
+        self.listed = 0  # directories read from disk
+        self.entries = 0 # directory entries read from disk
+        self.stats = 0   # stat calls made to find out entry kinds
+        self.pruned = 0  # excluded directories that were not descended
+        self.excluded = 0 # entries an exclusion kept out, pruned included
+        self.probed = 0  # names looked up without reading their directory
+
+    def __repr__(self):
+        return ("<WalkStats listed=%d entries=%d stats=%d pruned=%d "
+                "excluded=%d probed=%d>" % (self.listed, self.entries,
+                                            self.stats, self.pruned,
+                                            self.excluded, self.probed))
+
+
+def kindOf(mode):
+    """The entry kind of an os.stat() st_mode"""
+    if stat.S_ISDIR(mode):
+        return DIR
+    if stat.S_ISREG(mode):
+        return FILE
+    return OTHER
+
+
+class DirEntry(object):
+    """One entry of a directory listing.
+    name is the entry's name and path its absolute path.  The kind
+    follows symlinks, the way os.path.isdir() does, and is looked up at
+    most once.
+    """
+    __slots__ = ('name', 'path', '_kind', '_st', '_stats')
+
+    def __init__(self, name, path, stats, kind=None, st=None):
+        self.name = name
+        self.path = path
+        self._stats = stats
+        self._kind = kind
+        self._st = st
+
+    def __repr__(self):
+        return "<DirEntry %r>" % (self.path,)
+
+    def stat(self):
+        """Return the (cached) os.stat() result for this entry, or None if
+        it cannot be stat'ed
+        """
+        if self._st is None:
+            self._stats.stats = self._stats.stats + 1
+            try:
+                self._st = os.stat(self.path)
+            except OSError:
+                self._st = False
+        return self._st or None
+
+    def kind(self):
+        if self._kind is None:
+            st = self.stat()
+            if st is None:
+                self._kind = OTHER
+            else:
+                self._kind = kindOf(st.st_mode)
+        return self._kind
+
+    def knownKind(self):
+        """The kind if it has already been found out, else None"""
+        return self._kind
+
+    def isdir(self):
+        return self.kind() == DIR
+
+    def isfile(self):
+        return self.kind() == FILE
+
+
+class _NativeEntry(DirEntry):
+    """A DirEntry wrapping an os.scandir() entry, whose kind usually
+    comes from the directory read itself
+    """
+    __slots__ = ('_native',)
+
+    def __init__(self, native, stats):
+        DirEntry.__init__(self, native.name, native.path, stats)
+        self._native = native
+
+    def stat(self):
+        if self._st is None:
+            self._stats.stats = self._stats.stats + 1
+            try:
+                self._st = self._native.stat()
+            except OSError:
+                self._st = False
+        return self._st or None
+
+    def kind(self):
+        if self._kind is None:
+            native = self._native
+            try:
+                if native.is_dir():
+                    self._kind = DIR
+                elif native.is_file():
+                    self._kind = FILE
+                else:
+                    self._kind = OTHER
+            except OSError:
+                self._kind = OTHER
+        return self._kind
+
+
+def _prefix(dirpath):
+    """dirpath, ready to have a name appended"""
+    if dirpath[-1:] in (os.sep, os.altsep):
+        return dirpath
+    return dirpath + os.sep
+
+
+class DirWalker:
+    """Lists directories by absolute path, remembering every listing so
+    that a directory is only ever read once per walker, until forget()
+    is called.  With a pool (an
+    inno.workers.WorkerPool), directories passed to prefetch() are read
+    in the pool's threads; listdir() still hands everything back in the
+    same order as it would without one.
+    Setting mtimes to a dict makes the walker record there the mtime each
+    directory had just before it was read or first looked into.
+    """
+    retains = 1 # whether a listing read once is there for the next asker
+
+    def __init__(self, pool=None):
+        self.stats = WalkStats()
+        self.listings = {}
+        self.pool = pool
+        self.pending = {}
+        self.mtimes = None
+        self.probes = {}   # {dirpath: {name: DirEntry or None}}
+        self._indexes = {} # {dirpath: {normcased name: DirEntry}}
+
+    def listdir(self, dirpath):
+        """Return the DirEntry objects for the absolute directory dirpath,
+        in the order the OS gives them
+        """
+        try:
+            return self.listings[dirpath]
+        except KeyError:
+            pass
+        job = self.pending.pop(dirpath, None)
+        if job is None:
+            entries = self.scandir(dirpath, self.stats)
+        else:
+            entries, stats = job.result()
+            self.stats.listed = self.stats.listed + stats.listed
+            self.stats.entries = self.stats.entries + stats.entries
+            self.stats.stats = self.stats.stats + stats.stats
+        self.listings[dirpath] = entries
+        return entries
+
+    def lookup(self, dirpath, name):
+        """Return the DirEntry for name in the absolute directory dirpath,
+        or None if it has no such entry.  A directory that has been (or is
+        being) read is searched; otherwise, where EXACT_NAMES holds, the
+        name is looked up with one lstat and dirpath is not read.
+        """
+        if (dirpath in self.listings or dirpath in self.pending
+            or not EXACT_NAMES):
+            index = self._indexes.get(dirpath)
+            if index is None:
+                normcase = os.path.normcase
+                index = self._indexes[dirpath] = dict(
+                    [(normcase(e.name), e) for e in self.listdir(dirpath)])
+            return index.get(os.path.normcase(name))
+        probes = self.probes.get(dirpath)
+        if probes is None:
+            if self.mtimes is not None:
+                self.mtimes[dirpath] = os.stat(dirpath).st_mtime
+            probes = self.probes[dirpath] = {}
+        try:
+            return probes[name]
+        except KeyError:
+            entry = probes[name] = self.probe(dirpath, name, self.stats)
+            return entry
+
+    def probe(self, dirpath, name, stats):
+        """Look name up in dirpath with one lstat, counting the work in
+        stats
+        """
+        path = _prefix(dirpath) + name
+        stats.probed = stats.probed + 1
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if stat.S_ISLNK(st.st_mode):
+            return DirEntry(name, path, stats) # its kind is its target's
+        return DirEntry(name, path, stats, kindOf(st.st_mode), st)
+
+    def keep(self, dirpath):
+        """Say that dirpath will be listed again soon.  This walker keeps
+        every listing anyway.
+        """
+
+    def release(self, dirpath):
+        """Undo one keep() of dirpath"""
+
+    def consulted(self):
+        """The directories read or looked into since they were last
+        forgotten, which is every directory a walk so far depended on
+        """
+        return self.listings.keys() + [d for d in self.probes
+                                       if d not in self.listings]
+
+    def forget(self, dirpath=None, recurse=1):
+        """Drop the listings of dirpath and of every directory below it (or
+        of dirpath alone, unless recurse), or all listings if dirpath is
+        None, so they will be read again
+        """
+        caches = (self.listings, self.pending, self.probes, self._indexes)
+        if dirpath is None:
+            for cache in caches:
+                cache.clear()
+            return
+        if not recurse:
+            for cache in caches:
+                cache.pop(dirpath, None)
+            return
+        below = _prefix(dirpath)
+        for cache in caches:
+            for d in cache.keys():
+                if d == dirpath or d.startswith(below):
+                    del cache[d]
+
+    def prefetch(self, dirpaths):
+        """Start reading the directories in dirpaths, if there is a pool to
+        read them with
+        """
+        if self.pool is None:
+            return
+        for dirpath in dirpaths:
+            if dirpath not in self.listings and dirpath not in self.pending:
+                self.pending[dirpath] = self.pool.submit(self._fetch, dirpath)
+
+    def _fetch(self, dirpath):
+        """Read dirpath and the kinds of its entries, in a pool thread"""
+        stats = WalkStats()
+        entries = self.scandir(dirpath, stats)
+        for e in entries:
+            e.kind()
+        return entries, stats
+
+    def scandir(self, dirpath, stats):
+        """Read dirpath, counting the work in stats"""
+        if self.mtimes is not None:
+            # stat before reading, so that a change made during the read
+            # shows up as a moved mtime
+            self.mtimes[dirpath] = os.stat(dirpath).st_mtime
+        return self.readdir(dirpath, stats)
+
+    def readdir(self, dirpath, stats):
+        """Read dirpath from disk, counting the work in stats"""
+        prefix = _prefix(dirpath)
+        if _scandir is not None:
+            entries = [_NativeEntry(e, stats) for e in _scandir(dirpath)]
+        else:
+            entries = [DirEntry(name, prefix + name, stats)
+                       for name in os.listdir(dirpath)]
+        stats.listed = stats.listed + 1
+        stats.entries = stats.entries + len(entries)
+        return entries
+
+
+class StreamingWalker(DirWalker):
+    """A DirWalker that forgets each listing as soon as it has handed it
+    out, unless its directory is held with keep(), and does not remember
+    names it looked up.  Memory stays with the directories a walk is in
+    the middle of rather than growing with the tree, but anything asked
+    for twice is read twice, and consulted() knows nothing of the past.
+    """
+    retains = 0
+
+    def __init__(self, pool=None):
+        DirWalker.__init__(self, pool)
+        self.held = {} # {dirpath: keep()s not yet released}
+
+    def keep(self, dirpath):
+        """Keep the listing of dirpath, once read, until release()"""
+        self.held[dirpath] = self.held.get(dirpath, 0) + 1
+
+    def release(self, dirpath):
+        count = self.held.get(dirpath, 0) - 1
+        if count > 0:
+            self.held[dirpath] = count
+            return
+        self.held.pop(dirpath, None)
+        for cache in (self.listings, self.probes, self._indexes):
+            cache.pop(dirpath, None)
+
+    def listdir(self, dirpath):
+        entries = DirWalker.listdir(self, dirpath)
+        if dirpath not in self.held:
+            del self.listings[dirpath]
+        return entries
+
+    def lookup(self, dirpath, name):
+        entry = DirWalker.lookup(self, dirpath, name)
+        if dirpath not in self.held:
+            self.probes.pop(dirpath, None)
+            self._indexes.pop(dirpath, None)
+        return entry
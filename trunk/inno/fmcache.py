@@ -0,0 +1,239 @@
+"""A persistent cache of fmscript results.
+
+A ManifestCache keeps, in one file, the mapping an fmscript produced and
+the modification time of every directory the run read, along with those
+directories' listings.  Running the same script again first stats the
+directories: if none has moved, the stored mapping comes back without
+anything being listed.  Otherwise the script runs again, but only the
+directories whose mtime moved are read from disk; the others are rebuilt
+from the stored listings.
+
+Adding, removing or renaming an entry changes its directory's mtime,
+which covers everything a mapping depends on but one thing: a symlink
+whose target turns from a file into a directory (or back) goes unseen.
+Writing the cache file moves the mtime of the directory it is in, so
+that one directory is checked by the names in it instead.
+
+A directory in which names were only looked up (see DirWalker.lookup)
+counts as read, and its mtime is kept, but it has no listing to keep.
+"""
+import os
+import time
+import cPickle
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from inno.dirwalk import DirWalker, DirEntry, RACY_SECONDS, _prefix
+from inno.fmlang import FileMapperParser
+from inno.atomicfile import writeFile, isTemp
+
+MAGIC = 'fmcache 1'
+
+
+def scriptKey(fmscript, replacements={}, replaceDuplicates=0):
+    """A digest of everything besides the tree that decides what fmscript
+    maps to.  Relative chdirs make the current directory part of that.
+    """
+    items = replacements.items()
+    items.sort()
+    return md5(repr((fmscript, items, replaceDuplicates,
+                     os.getcwd()))).hexdigest()
+
+
+class CachedWalker(DirWalker):
+    """A DirWalker that takes the listing of any directory whose mtime
+    has not moved from a ManifestCache, and remembers the mtime of every
+    directory it lists in self.mtimes
+    """
+    def __init__(self, cache, pool=None):
+        DirWalker.__init__(self, pool)
+        self.cache = cache
+        self.mtimes = {}
+
+    def readdir(self, dirpath, stats):
+        cached = self.cache.listing(dirpath, self.mtimes[dirpath])
+        if cached is None:
+            return DirWalker.readdir(self, dirpath, stats)
+        prefix = _prefix(dirpath)
+        names, kinds = cached
+        return [DirEntry(name, prefix + name, stats, kind)
+                for name, kind in zip(names, kinds)]
+
+
+class ManifestCache:
+    """The results of fmscripts and the listings they were made from,
+    kept in filename.  Several scripts can share one file; the most
+    recent maxResults results are kept.
+    """
+    maxResults = 8
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.results = []     # [(key, {dir: mtime}, items)], oldest first
+        self.listings = None  # {dir: (mtime, names, kinds)}, read lazily
+        self.hit = None       # whether the last run() was answered whole
+        self.stats = None     # the WalkStats of the last run() that walked
+        self.walker = None    # the CachedWalker of the last run()
+        self._offset = None
+        self._home = os.path.dirname(os.path.abspath(filename))
+        self.load()
+
+    def load(self):
+        """Read the results from the cache file.  A missing or unreadable
+        file is the same as an empty one.
+        """
+        self.results = []
+        self.listings = None
+        self._offset = None
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            self.listings = {}
+            return
+        try:
+            try:
+                if f.readline().rstrip() != MAGIC:
+                    raise ValueError("not an fmscript cache")
+                size = int(f.readline())
+                self.results = cPickle.loads(f.read(size))
+                self._offset = f.tell()
+            except Exception:
+                self.results = []
+                self.listings = {}
+        finally:
+            f.close()
+
+    def _loadListings(self):
+        if self.listings is not None:
+            return self.listings
+        self.listings = {}
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                f.seek(self._offset)
+                self.listings = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            pass
+        return self.listings
+
+    def save(self):
+        """Write the cache file, replacing it only once the new one is
+        complete
+        """
+        listings = self._loadListings()
+        wanted = {}
+        for key, mtimes, items in self.results:
+            wanted.update(mtimes)
+        for d in listings.keys():
+            if d not in wanted:
+                del listings[d]
+        results = cPickle.dumps(self.results, 2)
+        def write(f):
+            f.write('%s\n%d\n' % (MAGIC, len(results)))
+            f.write(results)
+            cPickle.dump(listings, f, 2)
+        writeFile(self.filename, write)
+
+    def listing(self, dirpath, mtime):
+        """The stored (names, kinds) of dirpath if it was listed at mtime,
+        else None
+        """
+        cached = self._loadListings().get(dirpath)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2]
+        return None
+
+    def _ownNames(self, names):
+        """names without the cache file's own"""
+        mine = os.path.basename(self.filename)
+        names = [n for n in names
+                 if n != mine and not isTemp(n, self.filename)]
+        names.sort()
+        return names
+
+    def _unchanged(self, dirpath, mtime):
+        """Whether dirpath is as it was when it was listed at mtime"""
+        if dirpath == self._home:
+            cached = self._loadListings().get(dirpath)
+            if cached is None:
+                return 0
+            try:
+                names = os.listdir(dirpath)
+            except OSError:
+                return 0
+            return self._ownNames(names) == self._ownNames(cached[1])
+        if mtime is None:
+            return 0
+        try:
+            return os.stat(dirpath).st_mtime == mtime
+        except OSError:
+            return 0
+
+    def lookup(self, key):
+        """The stored items for key, if no directory they came from has
+        changed since, else None
+        """
+        for k, mtimes, items in self.results:
+            if k == key:
+                for d, mtime in mtimes.iteritems():
+                    if not self._unchanged(d, mtime):
+                        return None
+                return items
+        return None
+
+    def store(self, key, walker, items):
+        """Remember items as the result for key, and the listings walker
+        (a CachedWalker) read to get them
+        """
+        listings = self._loadListings()
+        recent = time.time() - RACY_SECONDS
+        mtimes = {}
+        for d in walker.consulted():
+            mtime = walker.mtimes.get(d)
+            if d != self._home and (mtime is None or mtime > recent):
+                # read it again next time rather than trust it
+                mtimes[d] = None
+                listings.pop(d, None)
+                continue
+            mtimes[d] = mtime
+            entries = walker.listings.get(d)
+            if entries is not None:
+                listings[d] = (mtime, [e.name for e in entries],
+                               [e.knownKind() for e in entries])
+            elif d == self._home:
+                # only looked into, but this one is checked by its names
+                names = os.listdir(d)
+                listings[d] = (mtime, names, [None] * len(names))
+        self.results = [r for r in self.results if r[0] != key]
+        self.results.append((key, mtimes, items))
+        del self.results[:-self.maxResults]
+        self.save()
+
+    def run(self, fmscript, replacements={}, replaceDuplicates=0,
+            workers=0):
+        """Return the (destination, source) items fmscript maps to, as
+        FileMapperParser.data.items() would after runScript(), using and
+        then updating the cache.  Afterwards walker reads the tree again
+        without reading any directory twice: it has what the run read,
+        or after a hit takes the stored listings of directories that have
+        not moved.
+        """
+        key = scriptKey(fmscript, replacements, replaceDuplicates)
+        items = self.lookup(key)
+        if items is not None:
+            self.hit = 1
+            self.walker = CachedWalker(self)
+            return items
+        self.hit = 0
+        fmp = FileMapperParser(replacements, workers=workers)
+        fmp.replaceDuplicates = replaceDuplicates
+        fmp.walker = self.walker = CachedWalker(self, fmp.walker.pool)
+        fmp.runScript(fmscript)
+        self.stats = fmp.walker.stats
+        items = fmp.data.items()
+        self.store(key, fmp.walker, items)
+        return items
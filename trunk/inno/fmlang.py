@@ -22,7 +22,10 @@ The only commands it understands are:
   diradd [<glob>]
     add directories matching glob (not their contents--use for empty dirs)
   exclude <glob>
-    from now on, don\'t grab any files that match this glob
+    from now on, don\'t grab any files that match this glob, or anything
+    below directories that match it
+  profile [on|off]
+    record what each command costs from now on (or stop), or print it
   show
     print the current list of dest:source mappings to stdout
   unexclude <glob>
@@ -73,119 +76,817 @@ The above might produce::
  ('Xsession.options', '/etc/X11/Xsession.options'),
  ('Xwrapper.config',  '/etc/X11/Xwrapper.config')]
 """
-from itertools import chain
+from itertools import chain, islice
 
 import os
 import cmd
+import time
 import shlex
 from cStringIO import StringIO
 import re
 import fnmatch
+import cPickle
+import threading
+from array import array
+from UserDict import DictMixin
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
 
 from inno.path import path
+from inno.dirwalk import DirWalker, StreamingWalker, FILE, DIR, OTHER, kindOf
+from inno.workers import WorkerPool
+from inno.atomicfile import writeFile
 
-def gatherHits(curdir, components, xglobs=()):
-    if len(components)==0:
-        return []
-    gathered = OrderedDict()
-    add = lambda d,s: gathered.__setitem__(str(d), str(s))
-    here = path(curdir)
-    comp = path(components.pop(0))
+class GlobMatcher:
+    """A glob compiled once into a little automaton over path components.
+
+    State i means "the next name has to match component i".  A ** that is
+    not the last component matches any number of directories, so from its
+    state a directory leads both back to the same state and on to the
+    next one.  A component without wildcards matches just one name, kept in
+    literals so that it can be looked up instead of matched against a
+    whole directory.  Use compileGlob() rather than making these
+    directly, so that each pattern string is only compiled once.
+    """
+    def __init__(self, glob):
+        self.glob = glob
+        if glob in ('', None): glob = '*'
+        # sanity check.. make sure glob uses os.sep
+        self.components = str(path(glob).normpath()).split(os.sep)
+        self.steps = []
+        self.literals = []
+        for comp in self.components:
+            if comp=='**':
+                self.steps.append(None)
+            else:
+                pat = os.path.normcase(comp)
+                self.steps.append(re.compile(fnmatch.translate(pat)).match)
+            # no directory lists '', '.' or '..', so they match nothing
+            if (comp != '**' and _isLiteral(comp)
+                and comp not in ('', os.curdir, os.pardir)):
+                self.literals.append(comp)
+            else:
+                self.literals.append(None)
+        self.last = len(self.steps) - 1
+        # how many ** a path can be split at, each split being another
+        # way to the same destination
+        self.recursions = len([i for i in range(len(self.steps))
+                               if self.recurses(i)])
+
+    def __repr__(self):
+        return "<GlobMatcher %r>" % (self.glob,)
+
+    def recurses(self, i):
+        """Whether state i is a ** with more components after it"""
+        return self.steps[i] is None and i < self.last
+
+    def closure(self, states):
+        """states, plus the states reachable from them without consuming a
+        name
+        """
+        closed = []
+        for i in states:
+            while i not in closed:
+                closed.append(i)
+                if not self.recurses(i):
+                    break
+                i = i + 1
+        return closed
+
+    def advance(self, states, name, isdir):
+        """Return (hit, final, nextstates) for the entry called name in a
+        directory reached in states.  hit says the entry is matched by
+        some prefix of the glob, final that it is matched by all of it.
+        """
+        name = os.path.normcase(name)
+        hit = final = 0
+        nextstates = []
+        for i in states:
+            step = self.steps[i]
+            if step is None:
+                if i == self.last:
+                    hit = final = 1
+                elif isdir:
+                    hit = 1
+                    nextstates.append(i)
+            elif step(name):
+                if i == self.last:
+                    hit = final = 1
+                elif isdir:
+                    hit = 1
+                    nextstates.append(i + 1)
+        return hit, final, self.closure(nextstates)
+
+    def match(self, relpath):
+        """Whether the whole glob matches relpath, a path relative to the
+        directory the glob is evaluated in.  Every component but the last
+        is taken to be a directory.
+        """
+        names = [n for n in str(path(relpath).normpath()).split(os.sep)
+                 if n != os.curdir]
+        if not names:
+            return 0
+        states = self.closure([0])
+        for name in names[:-1]:
+            states = self.advance(states, name, 1)[2]
+            if not states:
+                return 0
+        return self.advance(states, names[-1], 0)[1]
+
+_globCache = {}
+
+def compileGlob(glob):
+    """Return the GlobMatcher for glob, compiling it only the first time"""
+    try:
+        return _globCache[glob]
+    except KeyError:
+        if len(_globCache) >= 100:
+            _globCache.clear()
+        matcher = _globCache[glob] = GlobMatcher(glob)
+        return matcher
+
+def _isLiteral(glob):
+    """Whether glob has no wildcards in it"""
+    for c in '*?[':
+        if c in glob:
+            return 0
+    return 1
+
+def _globBody(glob):
+    """fnmatch.translate(glob) without its end anchor, so that several of
+    them can be joined into one regular expression
+    """
+    res = fnmatch.translate(glob)
+    if res.endswith('\\Z(?ms)'):
+        return res[:-7]
+    if res.startswith('(?s:') and res.endswith(')\\Z'):
+        return res[4:-3]
+    if res.endswith('$'):
+        return res[:-1]
+    return res
+
+def _joinGlobs(globs):
+    """One compiled regular expression matching any of globs"""
+    if not globs:
+        return None
+    bodies = ['(?:%s)' % _globBody(g) for g in globs]
+    return re.compile('(?:%s)\\Z' % '|'.join(bodies), re.S)
+
+class ExclusionMatcher:
+    """Decides whether an entry is excluded by any of a list of globs.
+    As ever, an entry is excluded when a glob matches either its whole
+    relative path or, case-normalized, just its name.  Globs without
+    wildcards (CVS, .svn) are looked up in sets; the rest are joined into
+    one regular expression for paths and one for names.
+    """
+    def __init__(self, globs=()):
+        self.globs = tuple(globs)
+        normcase = os.path.normcase
+        self.paths = set()
+        self.names = set()
+        wild = []
+        for xg in self.globs:
+            if _isLiteral(xg):
+                self.paths.add(xg)
+                self.names.add(normcase(xg))
+            else:
+                wild.append(xg)
+        self.pathre = _joinGlobs(wild)
+        self.namere = _joinGlobs([normcase(xg) for xg in wild])
+
+    def __repr__(self):
+        return "<ExclusionMatcher %r>" % (self.globs,)
+
+    def __nonzero__(self):
+        return len(self.globs) > 0
+
+    def __call__(self, dest, name):
+        """Whether the entry called name, at dest in the mapping, is
+        excluded
+        """
+        if not self.globs:
+            return 0
+        name = os.path.normcase(name)
+        if dest in self.paths or name in self.names:
+            return 1
+        if self.pathre is not None:
+            if self.pathre.match(dest) or self.namere.match(name):
+                return 1
+        return 0
+
+def gatherHits(curdir, glob, xglobs=(), walker=None, dest=None):
+    """Return (destination, source, kind) triples for the entries under
+    curdir matching glob and not matching any xglob.  kind is one of
+    inno.dirwalk's FILE, DIR or OTHER.  glob is a GlobMatcher or a
+    list of glob components, xglobs an ExclusionMatcher or a list of globs.
+    Destinations start with dest, which defaults to curdir.
+    Each directory is read at most once, through walker.
+    """
+    return list(iterHits(curdir, glob, xglobs, walker, dest))
+
+def iterHits(curdir, glob, xglobs=(), walker=None, dest=None):
+    """Like gatherHits(), but yield each triple as soon as the walk finds
+    it
+    """
+    if not isinstance(glob, GlobMatcher):
+        if len(glob)==0:
+            return
+        glob = compileGlob(os.sep.join(glob))
+    if walker is None:
+        walker = DirWalker()
     # the rule is:
     # 1. normal globs match files or dirs in the current directory
     # 2. ** recursive globs match any dir in the subtree including '.'
     # 3. unless there are no components left to process, in which case
     #    treat as a normal glob.
-    if len(components)==0:
-        matcher = here.listdir
+    if isinstance(xglobs, ExclusionMatcher):
+        excluded = xglobs
     else:
-        if str(comp)=='**':
-            matcher = lambda g: chain((here,), here.walkdirs(g))
+        excluded = ExclusionMatcher(xglobs)
+    if dest is None:
+        dest = str(curdir)
+    hits = _gather(walker, os.path.abspath(curdir), dest, glob, 0, excluded)
+    if not glob.recursions:
+        # there is one way to each destination
+        for hit in hits:
+            yield hit
+        return
+    # a directory can be reached by the ** walk and by the components after
+    # it; past more than one **, anything can
+    seen = set()
+    for hit in hits:
+        if glob.recursions == 1 and hit[2] != DIR:
+            yield hit
+            continue
+        key = _digest(hit[0])
+        if key not in seen:
+            seen.add(key)
+            yield hit
+
+def _digest(s):
+    """A short stand-in for the string s in a set of strings seen"""
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return md5(s).digest()
+
+def _prefix(dirname):
+    """dirname, ready to have a child name appended"""
+    if dirname[-1:] in (os.sep, os.altsep):
+        return dirname
+    return dirname + os.sep
+
+def _gather(walker, dirpath, dest, glob, i, excluded):
+    """Yield (destination, source, kind) for each hit below the directory
+    dirpath, which appears as dest in the mapping, reached in state i of
+    glob.  A destination may come up more than once.
+    """
+    if glob.recurses(i):
+        # ** matches this directory and every directory below it.  Each
+        # is listed by the rest of the glob and then by _walkdirs(), which
+        # releases it.
+        walker.keep(dirpath)
+        dirs = chain(((dirpath, dest, os.path.basename(dest)),),
+                     _walkdirs(walker, dirpath, dest, excluded))
+        for subpath, subdest, name in dirs:
+            if excluded(subdest, name):
+                walker.stats.excluded = walker.stats.excluded + 1
+                continue
+            yield subdest, subpath, DIR
+            for hit in _gather(walker, subpath, subdest, glob, i+1,
+                               excluded):
+                yield hit
+        return
+    literal = glob.literals[i]
+    if literal is not None:
+        # one name is all that can match; don't read the directory for it
+        entry = walker.lookup(dirpath, literal)
+        entries = entry is not None and [entry] or []
+    else:
+        entries = walker.listdir(dirpath)
+    match = glob.steps[i] or _matchAll
+    last = i == glob.last
+    destprefix = _prefix(dest)
+    normcase = os.path.normcase
+    hits = []
+    for e in entries:
+        if not match(normcase(e.name)):
+            continue
+        if not last and not e.isdir():
+            continue
+        subdest = destprefix + e.name
+        if excluded(subdest, e.name):
+            walker.stats.excluded = walker.stats.excluded + 1
+            if not last:
+                walker.stats.pruned = walker.stats.pruned + 1
+            continue
+        hits.append((e, subdest))
+    if last:
+        for e, subdest in hits:
+            yield subdest, e.path, e.kind()
+        return
+    if glob.literals[i+1] is None:
+        walker.prefetch([e.path for e, subdest in hits])
+    for e, subdest in hits:
+        yield subdest, e.path, DIR
+        for hit in _gather(walker, e.path, subdest, glob, i+1, excluded):
+            yield hit
+
+def _matchAll(name):
+    return 1
+
+def _walkdirs(walker, dirpath, dest, excluded):
+    """Yield (source, destination, name) for every directory below dirpath,
+    depth-first, each directory just before its children.  Excluded
+    directories are pruned: neither they nor anything below them is
+    yielded or even listed.
+    """
+    destprefix = _prefix(dest)
+    subdirs = []
+    entries = walker.listdir(dirpath)
+    walker.release(dirpath)
+    for e in entries:
+        if e.isdir():
+            subdest = destprefix + e.name
+            if excluded(subdest, e.name):
+                walker.stats.pruned = walker.stats.pruned + 1
+                walker.stats.excluded = walker.stats.excluded + 1
+                continue
+            subdirs.append((e, subdest))
+    walker.prefetch([e.path for e, subdest in subdirs])
+    for e, subdest in subdirs:
+        walker.keep(e.path)
+        yield e.path, subdest, e.name
+        for x in _walkdirs(walker, e.path, subdest, excluded):
+            yield x
+
+def walkPlan(walker, root, plan):
+    """Read, in one breadth-first pass, every directory under root that
+    the (GlobMatcher, ExclusionMatcher) pairs in plan may need, so that
+    evaluating them afterwards finds everything already in walker.  With a
+    pool the walker reads each level of the tree in parallel.  Guessing
+    wrong only costs time: anything read here that nobody needs is wasted,
+    and anything missed is read when it is asked for.
+    """
+    threads = []
+    for glob, excluded in plan:
+        for i in glob.closure([0]):
+            threads.append((glob, i, excluded))
+    frontier = [(os.path.abspath(root), os.curdir, threads)]
+    while frontier:
+        frontier = [(dirpath, dest, threads, _literalNames(threads))
+                    for dirpath, dest, threads in frontier]
+        walker.prefetch([dirpath for dirpath, dest, threads, names in frontier
+                         if names is None])
+        below = {}
+        for dirpath, dest, threads, names in frontier:
+            try:
+                if names is None:
+                    entries = walker.listdir(dirpath)
+                else:
+                    entries = [walker.lookup(dirpath, name) for name in names]
+                    entries = [e for e in entries if e is not None]
+            except OSError:
+                continue # evaluating the plan will report this
+            destprefix = _prefix(dest)
+            for e in entries:
+                subthreads = _advanceThreads(threads, e, destprefix)
+                if subthreads:
+                    below[e.path] = (destprefix + e.name, subthreads)
+        frontier = [(dirpath, dest, threads)
+                    for dirpath, (dest, threads) in below.items()]
+
+def _literalNames(threads):
+    """The names a directory reached in threads is looked up for, if every
+    thread wants one name in it, else None
+    """
+    names = []
+    for glob, i, excluded in threads:
+        name = glob.literals[i]
+        if name is None:
+            return None
+        if name not in names:
+            names.append(name)
+    return names
+
+def _advanceThreads(threads, e, destprefix):
+    """The (glob, state, excluder) threads that carry on into the entry e
+    from a directory reached in threads
+    """
+    normcase = os.path.normcase
+    name = normcase(e.name)
+    subthreads = set()
+    for glob, i, excluded in threads:
+        if glob.recurses(i):
+            nextstates = [i, i + 1]
         else:
-            matcher = here.dirs
-    xrelist = [] # list of regular expressions for matching excluded files
-    for xg in xglobs:
-        cre = re.compile(fnmatch.translate(xg))
-        xrelist.append(cre)
-    for f in matcher(comp):
-        excluded = 0
-        # filter with xglobs
-        for xg, xg_re in zip(xglobs, xrelist):
-            if re.match(xg_re, f) or f.fnmatch(xg):
-                excluded = 1
-                break
-        if not excluded:
-            add(f, f.abspath())
-            if f.isdir():
-                for d, s in gatherHits(f, components[:], xglobs):
-                    add(d,s)
-    return gathered.items()
-    
-    
+            step = glob.steps[i]
+            if i == glob.last or (step is not None and not step(name)):
+                continue
+            nextstates = [i + 1]
+        if not e.isdir() or excluded(destprefix + e.name, e.name):
+            continue
+        for j in glob.closure(nextstates):
+            subthreads.add((glob, j, excluded))
+    return subthreads
 
-def matches(curdir, glob, xglobs=()):
-    """Return the entries that match glob and do not match any xglob"""
-    old = os.getcwd()
-    os.chdir(curdir)
-    try:
-        # sanity check.. make sure glob uses os.sep
-        if glob in ('', None): glob = '*'
-        glob = path(glob).normpath()
-        components = str(glob).split(os.sep)
-        return gatherHits('.', components, xglobs)
-    finally:
-        os.chdir(old)
+def matches(curdir, glob, xglobs=(), walker=None):
+    """Return the entries that match glob and do not match any xglob.
+    Destinations are relative to curdir, as in '.\\file'.  The process's
+    current directory is never changed, so parsers may run in threads.
+    """
+    return gatherHits(curdir, compileGlob(glob), xglobs, walker, os.curdir)
 
 wordchars = ''.join([chr(n) for n in range(255)
                      if n not in (9,10,13,32,34,39)])
 
-def cleanLine(line):
-    """pass line through shlex to get rid of comments and extra args"""
+# One token as the non-posix shlex set up by _shlexTokens reads it, from a
+# line with no newline in it: a quoted string, kept with its quotes; a
+# word, which may have quotes inside but not in front; or chr(255), the
+# one character that is neither a word character, whitespace, a quote
+# nor the comment character.  Matching none of these means the end of the
+# line or a comment running to it, after which shlex has only ''.
+# A lone quote is a string that is never closed.
+_token = re.compile(r'''[ \t\r]*(?:('[^']*'|"[^"]*")'''
+                    r'''|([^ \t\r#\xff'"][^ \t\r#\xff]*)|(\xff)|(['"]))?''')
+
+def _shlexTokens(line):
+    """The first two tokens shlex finds in line, '' for missing ones"""
     sio = StringIO(line)
     lexer = shlex.shlex(sio)
     lexer.wordchars = wordchars
     # lexer.debug = 1
     gt = lexer.get_token
     # in non-posix shlex returns None for EOF, so kludge with {or ''}
-    cmd, arg = gt() or '', gt() or ''
-    if len(arg)>=1 and arg[0] in lexer.quotes:
+    return gt() or '', gt() or ''
+
+def splitLine(line):
+    """Return the command and argument words of line, with comments and
+    extra words dropped and quotes taken off the argument.  The result is
+    what shlex makes of line, but found with one precompiled pattern.
+    """
+    if '\n' in line:
+        # a comment only runs to the end of the line, which takes the
+        # whole of shlex's rules to get right
+        cmd, arg = _shlexTokens(line)
+    else:
+        match = _token.match
+        arg = ''
+        m = match(line)
+        if m.group(4):
+            raise ValueError, "No closing quotation"
+        cmd = m.group(1) or m.group(2) or m.group(3) or ''
+        if cmd:
+            m = match(line, m.end())
+            if m.group(4):
+                raise ValueError, "No closing quotation"
+            arg = m.group(1) or m.group(2) or m.group(3) or ''
+    if arg[:1] in ('"', "'"):
         arg = arg[1:-1]
-    return ' '.join((cmd, arg))
+    return cmd, arg
+
+def cleanLine(line):
+    """pass line through shlex to get rid of comments and extra args"""
+    return ' '.join(splitLine(line))
+
+
+class CommandStats:
+    """What running one command cost"""
+    def __init__(self, line):
+        self.line = line
+        self.seconds = 0.0
+        self.listed = 0   # directories read from disk
+        self.entries = 0  # directory entries read from disk
+        self.stats = 0    # stat calls made to find out entry kinds
+        self.probed = 0   # names looked up without reading their directory
+        self.excluded = 0 # entries an exclusion kept out
+        self.added = 0    # growth of the mapping
+
+    def __repr__(self):
+        return "<CommandStats %r %.3fs>" % (self.line, self.seconds)
+
+
+class ParserProfile:
+    """The CommandStats of every command a FileMapperParser ran while
+    its profiling attribute was true, in order.  Reading the tree ahead
+    for a planned runScript() shows up as a command of its own.
+
+    The counts are the differences in the walker's WalkStats, which it
+    keeps whether or not anybody is profiling; switched off, profiling
+    costs one attribute test per command.
+    """
+    columns = ('seconds', 'listed', 'entries', 'stats', 'probed',
+               'excluded', 'added')
+
+    def __init__(self):
+        self.commands = []
+
+    def measure(self, fmp, line, func, *args):
+        """Call func(*args), recording what it cost fmp as line"""
+        ws = fmp.walker.stats
+        before = (time.time(), ws.listed, ws.entries, ws.stats, ws.probed,
+                  ws.excluded, len(fmp.data))
+        try:
+            return func(*args)
+        finally:
+            after = (time.time(), ws.listed, ws.entries, ws.stats,
+                     ws.probed, ws.excluded, len(fmp.data))
+            cs = CommandStats(line)
+            (cs.seconds, cs.listed, cs.entries, cs.stats, cs.probed,
+             cs.excluded, cs.added) = [a - b for a, b in zip(after, before)]
+            self.commands.append(cs)
+
+    def total(self):
+        """A CommandStats adding up all the commands"""
+        t = CommandStats('total')
+        for cs in self.commands:
+            for c in self.columns:
+                setattr(t, c, getattr(t, c) + getattr(cs, c))
+        return t
+
+    def table(self):
+        """The stats as a table, one command to a row"""
+        rows = ["%8s %7s %8s %6s %6s %8s %7s  %s" %
+                (self.columns + ('command',))]
+        for cs in self.commands + [self.total()]:
+            rows.append("%8.3f %7d %8d %6d %6d %8d %7d  %s" % (
+                cs.seconds, cs.listed, cs.entries, cs.stats, cs.probed,
+                cs.excluded, cs.added, cs.line))
+        return '\n'.join(rows)
 
 
 class FileMapperParser(cmd.Cmd):
     """An implementation of the FileMapper command set.  Use
     FileMapperParser.onecmd(s) to issue a command.
+    With workers > 1, directories are read by that many threads at once,
+    which helps on network filesystems; results come out the same.
+
+    Directory listings are kept for the whole session, so later commands
+    over the same tree do not read it again.  Call invalidate() if the
+    tree changes under the parser.  add and diradd store what they find
+    in data batchSize items at a time, as the walk goes.
+
+    runScript() runs a whole fmscript at once, reading everything its add
+    and diradd commands need in one shared walk per chdir before running
+    them in order.
+
+    With retain false, listings are not kept at all (see
+    inno.dirwalk.StreamingWalker): memory then stays flat however big the
+    tree, but every command reads what it needs again, and runScript()
+    does not plan.
+
+    With compact set, data is a CompactManifest rather than an
+    OrderedDict, for very large manifests, and retain defaults to false.
+    data may also be replaced before running anything with any mapping
+    that follows OrderedDict's rules, such as
+    inno.sqlmanifest.SQLiteManifest; if it has a batchSize, add and
+    diradd store that many items at a time.
+
+    While profiling is true, what each command costs is recorded in
+    profile, a ParserProfile; the profile command prints it.
     """
+    batchSize = 1000
+
     def __init__(self, replacements={}, *args, **kwargs):
+        # keywords only, so that cmd.Cmd's arguments keep their places
+        workers = kwargs.pop('workers', 0)
+        compact = kwargs.pop('compact', 0)
+        retain = kwargs.pop('retain', not compact)
         cmd.Cmd.__init__(self, *args, **kwargs)
+        pool = None
+        if workers > 1:
+            pool = WorkerPool(workers)
+        if retain:
+            self.walker = DirWalker(pool)
+        else:
+            self.walker = StreamingWalker(pool)
         self.replacements = replacements
         self.exclusions = []
+        self._excluder = None
         self.replaceDuplicates = 0
-        self.data = OrderedDict()
+        if compact:
+            self.data = CompactManifest()
+        else:
+            self.data = OrderedDict()
         self.cwd = path('.')
+        self.profiling = 0
+        self.profile = ParserProfile()
 
     def parseline(self, line):
-        line = cleanLine(line % self.replacements)
-        pos = line.find(' ')
-        word1 = line[:pos]
-        word2 = line[pos+1:]
-        return word1 or None, word2 or None, line.strip()
+        cmd, arg = splitLine(line % self.replacements)
+        line = ' '.join((cmd, arg))
+        if ' ' in cmd:
+            # a quoted command word splits at its first space
+            pos = line.find(' ')
+            cmd, arg = line[:pos], line[pos+1:]
+        return cmd or None, arg or None, line.strip()
+
+    def compileScript(self, fmscript):
+        """Parse every line of fmscript, returning a list of (command,
+        argument, line) for runCommand().  A script compiled before by
+        the same class with the same replacements comes from scriptCache
+        without parsing.
+        """
+        if 'parseline' in self.__dict__:
+            # parsed by this instance alone, so nobody else's to share
+            return [self.parseline(l) for l in fmscript.splitlines()]
+        cache = scriptCache
+        key = cache.key(fmscript, self.replacements, self.__class__)
+        commands = cache.get(key)
+        if commands is None:
+            commands = [self.parseline(l) for l in fmscript.splitlines()]
+            cache.put(key, commands)
+        return commands
+
+    def followScript(self, commands):
+        """Follow the chdir, exclude and unexclude commands in a compiled
+        script without running any of them, and return a list of
+        (command, root, GlobMatcher, ExclusionMatcher) for its add and
+        diradd commands, in order
+        """
+        cwd = self.cwd
+        exclusions = self.exclusions[:]
+        excluded = self.excluder()
+        steps = []
+        for cmd, arg, line in commands:
+            if cmd in ('chdir', 'cd'):
+                if arg is None:
+                    break
+                cwd = (cwd / arg).normpath()
+                if not cwd.isdir():
+                    break # running the script will raise here
+            elif cmd == 'exclude':
+                exclusions.append(arg)
+                excluded = ExclusionMatcher(exclusions)
+            elif cmd == 'unexclude':
+                if arg in exclusions:
+                    exclusions.remove(arg)
+                    excluded = ExclusionMatcher(exclusions)
+            elif cmd in ('add', 'diradd'):
+                steps.append((cmd, os.path.abspath(cwd), compileGlob(arg),
+                              excluded))
+        return steps
+
+    def planScript(self, commands):
+        """Return a list of (root, [(GlobMatcher, ExclusionMatcher), ...])
+        for the add and diradd commands of a compiled script under each
+        root, in order of first use (see followScript())
+        """
+        plans = OrderedDict()
+        for cmd, root, glob, excluded in self.followScript(commands):
+            if root not in plans:
+                plans[root] = []
+            plans[root].append((glob, excluded))
+        return plans.items()
+
+    def runScript(self, fmscript, planned=1):
+        """Run every command in fmscript.  When planned, first read all
+        that the script will need in one walk per root; the results are
+        exactly as if each line were given to onecmd() in turn.
+        """
+        commands = self.compileScript(fmscript)
+        if planned and self.walker.retains:
+            for root, plan in self.planScript(commands):
+                if self.profiling:
+                    self.profile.measure(self, '(read ahead %s)' % root,
+                                         walkPlan, self.walker, root, plan)
+                else:
+                    walkPlan(self.walker, root, plan)
+        for command in commands:
+            self.runCommand(*command)
+
+    def iterScript(self, fmscript, planned=0):
+        """Run fmscript like runScript(), but rather than storing what add
+        and diradd find in data, yield (destination, source, kind) for each
+        hit as soon as the walk finds it.  To catch duplicates, a digest of
+        each destination is kept: one found again raises
+        DuplicateFileException (with None for the earlier source, which is
+        not kept), or with replaceDuplicates is yielded again with its new
+        source.  Nothing is kept when only one command adds anything.
+        Planning reads the whole tree before the first hit can come out,
+        so it is off by default here.
+        """
+        commands = self.compileScript(fmscript)
+        if planned and self.walker.retains:
+            for root, plan in self.planScript(commands):
+                walkPlan(self.walker, root, plan)
+        seen = None
+        adds = [c for c in commands if c[0] in ('add', 'diradd')]
+        if len(adds) > 1 and not self.replaceDuplicates:
+            seen = set()
+        for cmd, arg, line in commands:
+            if cmd == 'add':
+                hits = self._iterAdd(arg)
+            elif cmd == 'diradd':
+                hits = self._iterDiradd(arg)
+            else:
+                self.runCommand(cmd, arg, line)
+                continue
+            self.lastcmd = line
+            for hit in hits:
+                dest = hit[0]
+                if seen is not None:
+                    key = _digest(dest)
+                    if key in seen:
+                        raise DuplicateFileException([(dest, hit[1], None)])
+                    seen.add(key)
+                if dest in self.data and not self.replaceDuplicates:
+                    raise DuplicateFileException(
+                        [(dest, hit[1], self.data[dest])])
+                yield hit
+
+    def onecmd(self, line):
+        return self.runCommand(*self.parseline(line))
+
+    def runCommand(self, cmd, arg, line):
+        """Run one command parsed by parseline(), as onecmd() does"""
+        if self.profiling and line and cmd != 'profile':
+            return self.profile.measure(self, line, self._runCommand,
+                                        cmd, arg, line)
+        return self._runCommand(cmd, arg, line)
 
-    def _update(self, dct):
+    def _runCommand(self, cmd, arg, line):
+        if not line:
+            return self.emptyline()
+        if cmd is None:
+            return self.default(line)
+        self.lastcmd = line
+        try:
+            func = getattr(self, 'do_' + cmd)
+        except AttributeError:
+            return self.default(line)
+        return func(arg)
+
+    def excluder(self):
+        """The ExclusionMatcher for the current exclusions, compiled again
+        only after exclude or unexclude changed them
+        """
+        if self._excluder is None:
+            self._excluder = ExclusionMatcher(self.exclusions)
+        return self._excluder
+
+    def _iterAdd(self, glob):
+        for dest, src, kind in iterHits(self.cwd, compileGlob(glob),
+                                        self.excluder(), self.walker,
+                                        os.curdir):
+            if kind != DIR:
+                yield dest, src, kind
+
+    def _iterDiradd(self, glob):
+        for dest, src, kind in iterHits(self.cwd, compileGlob(glob),
+                                        self.excluder(), self.walker,
+                                        os.curdir):
+            if kind != FILE:
+                yield dest + os.sep, src, kind
+
+    def invalidate(self, directory=None):
+        """Forget the cached listings of directory (relative to the current
+        chdir) and everything below it, or of every directory
+        """
+        if directory is None:
+            self.walker.forget()
+        else:
+            self.walker.forget(os.path.abspath(self.cwd / directory))
+
+    def _store(self, hits):
+        """Put the (destination, source, kind) hits in data a batch at a
+        time.  Unless replaceDuplicates, destinations already in data
+        raise DuplicateFileException once all the hits are checked, and
+        data is left as it was.
+        """
+        size = getattr(self.data, 'batchSize', self.batchSize)
+        before = len(self.data)
+        dupes = []
+        batch = []
+        for dest, src, kind in hits:
+            batch.append((dest, src))
+            if len(batch) >= size:
+                self._storeBatch(batch, dupes)
+                batch = []
+        if batch:
+            self._storeBatch(batch, dupes)
+        if dupes:
+            # the batches stored before the first duplicate were all new
+            # destinations, so they are the ones after the old end
+            stored = list(islice(self.data, before, None))
+            for dest in stored:
+                del self.data[dest]
+            raise DuplicateFileException(dupes)
+
+    def _storeBatch(self, batch, dupes):
         if not self.replaceDuplicates:
-            dupes = [(k,dct[k],self.data[k]) for k in dct if k in self.data]
+            data = self.data
+            dupes.extend([(k, v, data[k]) for k, v in batch if k in data])
             if dupes:
-                raise DuplicateFileException(dupes)
-        self.data.update(dct)
+                return
+        self.data.update(OrderedDict(batch))
 
     def do_add(self, glob):
         """grab all files (not subdirectories) in this dir matching the
         glob
         """
-        hits = matches(self.cwd, glob, self.exclusions)
-        [hits.remove(x) for x in hits[:] if path(x[1]).isdir()]
-        self._update(OrderedDict(hits))
+        self._store(self._iterAdd(glob))
 
     def do_chdir(self, directory):
         """from now on, add all entries relative to this directory"""
@@ -199,22 +900,20 @@ class FileMapperParser(cmd.Cmd):
         """add directories matching this glob (not its contents -
         use for empty dirs)
         """
-        hits = []
-        for m in matches(self.cwd, glob, self.exclusions):
-            hits.append((m[0] + os.sep, m[1]))
-        [hits.remove(x) for x in hits[:] if path(x[1]).isfile()]
-        self._update(OrderedDict(hits))
+        self._store(self._iterDiradd(glob))
         
     def do_exclude(self, glob):
         """from now on, don't grab any files that match this glob"""
         # TODO - this should probably raise an error if glob is missing
         self.exclusions.append(glob)
+        self._excluder = None
 
     def do_unexclude(self, glob):
         """stop excluding this glob, if it was previously excluded"""
         # TODO - this should probably raise an error if glob is missing
         if glob in self.exclusions:
             self.exclusions.remove(glob)
+            self._excluder = None
 
     def do_show(self, glob):
         """Return the list"""
@@ -222,6 +921,17 @@ class FileMapperParser(cmd.Cmd):
         for d,s in self.data.items():
             print "%24s: %s" % (d, s)
 
+    def do_profile(self, arg):
+        """profile on: record what each command costs from now on;
+        profile off: stop recording; profile: print what was recorded
+        """
+        if arg == 'on':
+            self.profiling = 1
+        elif arg == 'off':
+            self.profiling = 0
+        else:
+            print self.profile.table()
+
     def emptyline(self):
         """Don't repeat the last command"""
         pass
@@ -245,55 +955,558 @@ class OrderedDict(dict):
     it from a regular (non-ordered) dict, the new items will not be in any
     order (but will follow all the old items). Updating from another
     OrderedDict will preserve the order of both dicts.
+
+    Setting a key to a different value moves it to the end; setting it to
+    the value it already has changes nothing.  The order is kept in a
+    doubly linked list of [previous, next, key] cells indexed by key, so
+    inserting, replacing and deleting all take constant time.
     """
     def __init__(self, t=()):
-        self.order = []
+        dict.__init__(self)
+        self._clearOrder()
         for k, v in t:
             self[k] = v
-        
+
+    def _clearOrder(self):
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._cells = {}
+
     def __setitem__(self, k, v): 
         # Replacing items with the same value changes the order, so don't
         # replace items 
-        if k in self.keys() and v==self[k]:
-            return
+        cells = self._cells
+        if k in cells:
+            if v==dict.__getitem__(self, k):
+                return
+            self._unlink(k)
         dict.__setitem__(self, k, v)
-        if k in self.order:
-            self.order.remove(k)
-        self.order.append(k)
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = cells[k] = [last, root, k]
+
+    def _unlink(self, k):
+        prev, next, key = self._cells.pop(k)
+        prev[1] = next
+        next[0] = prev
+
     def __delitem__(self, k):
         dict.__delitem__(self, k)
-        self.order.remove(k)
+        self._unlink(k)
+
+    def pop(self, k, *default):
+        if k not in self._cells:
+            return dict.pop(self, k, *default)
+        v = dict.pop(self, k)
+        self._unlink(k)
+        return v
+
+    def setdefault(self, k, v=None):
+        if k not in self._cells:
+            self[k] = v
+        return dict.__getitem__(self, k)
+
+    def __iter__(self):
+        root = self._root
+        cell = root[1]
+        while cell is not root:
+            yield cell[2]
+            cell = cell[1]
+    iterkeys = __iter__
+
+    def itervalues(self):
+        get = dict.__getitem__
+        for k in self:
+            yield get(self, k)
+
+    def iteritems(self):
+        get = dict.__getitem__
+        for k in self:
+            yield k, get(self, k)
+
+    def keys(self):
+        """Return a list with the dict's keys, in order"""
+        return list(self)
+
+    def values(self):
+        """Return a list with the dict's values, in order"""
+        return list(self.itervalues())
+
     def items(self):
         """Return a list with the dict's items, in order"""
-        return [(k, dict.get(self, k)) for k in self.order]
+        return list(self.iteritems())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+    def __reduce__(self):
+        return (self.__class__, (self.items(),))
+
     def copy(self):
-        new1 = WhinyOrderedDict()
-        for k, v in self.items():
-            new1[k] = v
-        return new1
+        return self.__class__(self.iteritems())
+
     def update(self, d):
         for k,v in d.items(): self[k] = v
+
     def clear(self):
         r = dict.clear(self)
-        self.order = []
+        self._clearOrder()
         return r
+
     def popitem(self):
-        k, v = self.items()[0]
+        cell = self._root[1]
+        if cell is self._root:
+            raise KeyError('popitem(): dictionary is empty')
+        k = cell[2]
+        v = dict.__getitem__(self, k)
         del self[k]
         return k, v
 
+# CompactManifest markers: a destination with no directory part, a dead
+# slot, and never-used and emptied cells of the hash table
+_NODIR = -1
+_DELETED = -2
+_EMPTY = -1
+_DUMMY = -2
+
+class CompactManifest(DictMixin):
+    """An ordered mapping of destination to source paths that follows the
+    same rules as OrderedDict, for manifests too big to keep as two
+    strings and a dict entry apiece.  Each directory path is stored once;
+    an entry is a slot in parallel arrays holding its destination and
+    source directory numbers, its hash, and the base name the destination
+    and source usually share.  Destinations are found through an
+    open-addressing hash table of slot numbers, also an array.
+    Deleting leaves a dead slot; the arrays are packed again once dead
+    slots outnumber live ones.
+    """
+    def __init__(self, t=()):
+        self.clear()
+        for k, v in t:
+            self[k] = v
+
+    def clear(self):
+        self._dirPaths = []     # directory number: path
+        self._dirNumbers = {}   # path: directory number
+        self._destDirs = array('l')
+        self._srcDirs = array('l')
+        self._hashes = array('l')
+        self._names = []        # slot: destination base name
+        self._srcNames = {}     # slot: source base name, where different
+        self._table = array('l', [_EMPTY]) * 8
+        self._used = 0          # table cells not _EMPTY
+        self._len = 0
+        self._first = 0         # no live slot comes before this one
+
+    def _split(self, p):
+        """(directory number, base name) of path p, numbering its
+        directory if it is new
+        """
+        i = p.rfind(os.sep)
+        if i < 0:
+            return _NODIR, p
+        d = p[:i]
+        n = self._dirNumbers.get(d)
+        if n is None:
+            n = self._dirNumbers[d] = len(self._dirPaths)
+            self._dirPaths.append(d)
+        return n, p[i+1:]
+
+    def _join(self, n, name):
+        if n == _NODIR:
+            return name
+        return self._dirPaths[n] + os.sep + name
+
+    def _key(self, slot):
+        return self._join(self._destDirs[slot], self._names[slot])
+
+    def _value(self, slot):
+        name = self._srcNames.get(slot, self._names[slot])
+        return self._join(self._srcDirs[slot], name)
+
+    def _cell(self, k, h):
+        """The table cell holding k's slot, or the empty cell that ends
+        k's probe sequence
+        """
+        table, hashes = self._table, self._hashes
+        mask = len(table) - 1
+        i = h & mask
+        while 1:
+            slot = table[i]
+            if slot == _EMPTY:
+                return i
+            if slot >= 0 and hashes[slot] == h and self._key(slot) == k:
+                return i
+            i = (i + 1) & mask
+
+    def _slot(self, k):
+        slot = self._table[self._cell(k, hash(k))]
+        if slot == _EMPTY:
+            raise KeyError(k)
+        return slot
+
+    def __getitem__(self, k):
+        return self._value(self._slot(k))
+
+    def __contains__(self, k):
+        return self._table[self._cell(k, hash(k))] != _EMPTY
+    has_key = __contains__
+
+    def __len__(self):
+        return self._len
+
+    def __setitem__(self, k, v):
+        h = hash(k)
+        i = self._cell(k, h)
+        slot = self._table[i]
+        if slot != _EMPTY:
+            # same rules as OrderedDict
+            if v == self._value(slot):
+                return
+            self._kill(slot, i)
+            i = self._cell(k, h)
+        n, name = self._split(k)
+        srcn, srcname = self._split(v)
+        slot = len(self._names)
+        self._destDirs.append(n)
+        self._srcDirs.append(srcn)
+        self._hashes.append(h)
+        self._names.append(name)
+        if srcname != name:
+            self._srcNames[slot] = srcname
+        self._table[i] = slot
+        self._used = self._used + 1
+        self._len = self._len + 1
+        if self._used * 3 >= len(self._table) * 2:
+            self._rehash()
+
+    def __delitem__(self, k):
+        i = self._cell(k, hash(k))
+        slot = self._table[i]
+        if slot == _EMPTY:
+            raise KeyError(k)
+        self._kill(slot, i)
+        if len(self._names) > 2 * self._len + 1000:
+            self._pack()
+
+    def _kill(self, slot, cell):
+        self._table[cell] = _DUMMY
+        self._srcNames.pop(slot, None)
+        self._destDirs[slot] = _DELETED
+        self._names[slot] = None
+        self._len = self._len - 1
+
+    def _rehash(self):
+        """Rebuild the table, big enough for twice the live entries"""
+        size = 8
+        while size < self._len * 3:
+            size = size * 2
+        table = array('l', [_EMPTY]) * size
+        mask = size - 1
+        hashes = self._hashes
+        for slot in self._liveSlots():
+            i = hashes[slot] & mask
+            while table[i] != _EMPTY:
+                i = (i + 1) & mask
+            table[i] = slot
+        self._table = table
+        self._used = self._len
+
+    def _pack(self):
+        """Drop the dead slots"""
+        live = list(self._liveSlots())
+        destDirs, srcDirs, hashes = array('l'), array('l'), array('l')
+        names, srcNames = [], {}
+        for new, old in enumerate(live):
+            destDirs.append(self._destDirs[old])
+            srcDirs.append(self._srcDirs[old])
+            hashes.append(self._hashes[old])
+            names.append(self._names[old])
+            if old in self._srcNames:
+                srcNames[new] = self._srcNames[old]
+        self._destDirs, self._srcDirs, self._hashes = destDirs, srcDirs, hashes
+        self._names, self._srcNames = names, srcNames
+        self._first = 0
+        self._rehash()
+
+    def _liveSlots(self):
+        destDirs = self._destDirs
+        for slot in xrange(self._first, len(self._names)):
+            if destDirs[slot] != _DELETED:
+                yield slot
+
+    def __iter__(self):
+        for slot in self._liveSlots():
+            yield self._key(slot)
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for slot in self._liveSlots():
+            yield self._value(slot)
+
+    def iteritems(self):
+        for slot in self._liveSlots():
+            yield self._key(slot), self._value(slot)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+    def __reduce__(self):
+        return (self.__class__, (self.items(),))
+
+    def copy(self):
+        return self.__class__(self.iteritems())
+
+    def update(self, d):
+        for k,v in d.items(): self[k] = v
+
+    def popitem(self):
+        for slot in self._liveSlots():
+            self._first = slot
+            k, v = self._key(slot), self._value(slot)
+            del self[k]
+            return k, v
+        raise KeyError('popitem(): dictionary is empty')
+
+class ScriptCache:
+    """Compiled fmscripts, the (command, argument, line) lists
+    FileMapperParser.compileScript() makes, filed under a digest of the
+    script text, the replacements and the parser class, whose parseline()
+    made them.  The size most recently used are kept in memory and, given
+    a directory, also on disk, one file each, so that other processes
+    building the same script skip parsing too.
+    """
+    def __init__(self, size=64, directory=None):
+        self.size = size
+        self.directory = directory
+        self.scripts = OrderedDict() # least recently used first
+        self.lock = threading.Lock()
+
+    def key(self, fmscript, replacements={}, parser=None):
+        """The key of fmscript compiled by the class parser, by default
+        FileMapperParser, with replacements
+        """
+        if parser is None:
+            parser = FileMapperParser
+        items = replacements.items()
+        items.sort()
+        return md5(repr((fmscript, items, parser.__module__,
+                         parser.__name__))).hexdigest()
+
+    def get(self, key):
+        """The commands filed under key, or None.  They are shared, so
+        must not be changed.
+        """
+        self.lock.acquire()
+        try:
+            commands = self.scripts.get(key)
+            if commands is not None:
+                # move it to the recent end
+                del self.scripts[key]
+                self.scripts[key] = commands
+                return commands
+        finally:
+            self.lock.release()
+        if self.directory is None:
+            return None
+        filename = self._filename(key)
+        try:
+            f = open(filename, 'rb')
+            try:
+                commands = cPickle.load(f)
+            finally:
+                f.close()
+            os.utime(filename, None)
+        except Exception:
+            return None
+        self._remember(key, commands)
+        return commands
+
+    def put(self, key, commands):
+        """File commands under key"""
+        self._remember(key, commands)
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        writeFile(self._filename(key),
+                  lambda f: cPickle.dump(commands, f, 2))
+        self._evictFiles()
+
+    def clear(self):
+        """Forget every script, on disk as well"""
+        self.scripts.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.fmc'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.fmc')
+
+    def _remember(self, key, commands):
+        self.lock.acquire()
+        try:
+            self.scripts[key] = commands
+            while len(self.scripts) > self.size:
+                self.scripts.popitem()
+        finally:
+            self.lock.release()
+
+    def _evictFiles(self):
+        """Remove all but the size most recently used files"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.fmc'):
+                filename = os.path.join(self.directory, name)
+                try:
+                    files.append((os.stat(filename).st_mtime, filename))
+                except OSError:
+                    pass
+        if len(files) <= self.size:
+            return
+        files.sort()
+        for mtime, filename in files[:-self.size]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass # somebody else got there first
+
+scriptCache = ScriptCache()
+
 # utilities for processing fmscript with the parser
-def sourceItems(fmscript, replaceDuplicates=0):
-    """Return only the source files matched by the fmscript"""
+def scriptItems(fmscript, replaceDuplicates=0, cachefile=None):
+    """Return the (destination, source) items mapped by the fmscript.
+    With a cachefile, the result is kept there and is reused as long as
+    no directory it came from changes (see inno.fmcache)
+    """
+    if cachefile is not None:
+        from inno.fmcache import ManifestCache
+        cache = ManifestCache(cachefile)
+        return cache.run(fmscript, replaceDuplicates=replaceDuplicates)
     fmp = FileMapperParser()
     fmp.replaceDuplicates = replaceDuplicates
-    [fmp.onecmd(l) for l in fmscript.splitlines()]
-    if fmp.data.items():
-        return zip(*fmp.data.items())[0]
+    fmp.runScript(fmscript)
+    return fmp.data.items()
+
+class Source(tuple):
+    """One (destination, source) item of a manifest, with what collecting
+    it found out about the source: its kind (inno.dirwalk's FILE, DIR or
+    OTHER), and its size and mtime, which are None if it could not be
+    stat'ed.  It is the (destination, source) pair it stands for, so it
+    unpacks, compares and hashes as one.
+    """
+    def __new__(cls, dest, src, kind, size=None, mtime=None):
+        self = tuple.__new__(cls, (dest, src))
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        return self
+
+    dest = property(lambda self: self[0])
+    src = property(lambda self: self[1])
+
+    def __repr__(self):
+        return "<Source %r %r %s>" % (self[0], self[1], self.kind)
+
+    def __getnewargs__(self):
+        return (self[0], self[1], self.kind, self.size, self.mtime)
+
+    def withSource(self, src):
+        """This Source, installed from src instead, with src's own size
+        and mtime
+        """
+        if src == self[1]:
+            return self
+        try:
+            st = os.stat(src)
+        except OSError:
+            return Source(self[0], src, self.kind)
+        return Source(self[0], src, self.kind, st.st_size, st.st_mtime)
+
+def describeItems(items, walker=None):
+    """Return a Source for each (destination, source) item.  Sources walker
+    has seen keep the kind and stat found by the walk; the others are
+    stat'ed here, once each.
+    """
+    sources = []
+    for dest, src in items:
+        entry = None
+        if walker is not None:
+            dirpath, name = os.path.split(src)
+            if name:
+                try:
+                    entry = walker.lookup(dirpath, name)
+                except OSError:
+                    pass
+        if entry is not None:
+            kind, st = entry.kind(), entry.stat()
+        else:
+            try:
+                st = os.stat(src)
+                kind = kindOf(st.st_mode)
+            except OSError:
+                st, kind = None, OTHER
+        if st is None:
+            sources.append(Source(dest, src, kind))
+        else:
+            sources.append(Source(dest, src, kind, st.st_size, st.st_mtime))
+    return sources
+
+def scriptSources(fmscript, replaceDuplicates=0, cachefile=None,
+                  walker=None):
+    """Like scriptItems(), but return a Source for each item.  Unless the
+    result comes from cachefile, the tree is read through walker, if
+    given, which keeps the listings.
+    """
+    if cachefile is not None:
+        from inno.fmcache import ManifestCache
+        cache = ManifestCache(cachefile)
+        items = cache.run(fmscript, replaceDuplicates=replaceDuplicates)
+        return describeItems(items, cache.walker)
+    fmp = FileMapperParser()
+    fmp.replaceDuplicates = replaceDuplicates
+    if walker is not None:
+        fmp.walker = walker
+    fmp.runScript(fmscript)
+    return describeItems(fmp.data.items(), fmp.walker)
+
+def sourceItems(fmscript, replaceDuplicates=0, cachefile=None):
+    """Return only the source files matched by the fmscript"""
+    items = scriptItems(fmscript, replaceDuplicates, cachefile)
+    if items:
+        return tuple([dest for dest, src in items])
     else:
         return []
 
-def distutilsData(fmscript, replaceDuplicates=0, prefix=''):
+def iterMappings(fmscript, replaceDuplicates=0, workers=0, planned=0):
+    """Yield (destination, source, kind) for each entry the fmscript maps,
+    as the walk finds it, without keeping the mapping or the listings it
+    came from in memory.  See FileMapperParser.iterScript() for how
+    duplicates come out.  When planned, the tree is read in one walk
+    per root first, as runScript() does, and its listings are kept.
+    """
+    fmp = FileMapperParser(workers=workers, retain=planned)
+    fmp.replaceDuplicates = replaceDuplicates
+    return fmp.iterScript(fmscript, planned)
+
+def iterSources(fmscript, replaceDuplicates=0, workers=0, planned=0):
+    """Yield the source files matched by the fmscript one at a time, as
+    they are found"""
+    for dest, src, kind in iterMappings(fmscript, replaceDuplicates,
+                                        workers, planned):
+        yield dest
+
+def distutilsData(fmscript, replaceDuplicates=0, prefix='', cachefile=None):
     """Return a list of items compatible with distutils' datafiles setup arg:
     [(dirname, (source_items_in_dirname)), ...]
     
@@ -301,7 +1514,11 @@ def distutilsData(fmscript, replaceDuplicates=0, prefix=''):
     installation.  (Does not take care of fixing distutils' brain-dead
     handling of data files.   See Google for recipes to fix that. :-)
     """
-    items = sourceItems(fmscript, replaceDuplicates)
+    if cachefile is None and not replaceDuplicates:
+        # nothing can come out twice, so there is no need to keep it all
+        items = iterSources(fmscript, planned=1)
+    else:
+        items = sourceItems(fmscript, replaceDuplicates, cachefile)
     thedirs = {}
     for i in items:
         thedirs.setdefault(str(path(i).dirname()), []).append(i)
@@ -1,15 +1,233 @@
+"""Running the Inno Setup compiler, on one script or on many at once.
+
+python -m inno.runner [options] script.iss ... compiles .iss files in
+parallel; see main().
+"""
 import os
+import sys
+import time
+import traceback
+import subprocess
+from optparse import OptionParser
 
 from inno.process import ProcessOpen
 from inno.path import path
+from inno.workers import WorkerPool
+from inno.dedupe import fileDigest
 
 def sibpath(file1, name):
     return path(file1).dirname()/path(name)
 
 iscc = str(sibpath(__file__, "program")/"ISCC.exe")
 
-def build(script):
-    po = ProcessOpen((iscc, script))
+def compilerIdentity(compiler=None):
+    """Something that changes when the compiler is replaced"""
+    if compiler is None:
+        compiler = (iscc,)
+    identity = []
+    for arg in compiler:
+        try:
+            st = os.stat(arg)
+        except OSError:
+            identity.append((arg, None, None))
+        else:
+            identity.append((arg, st.st_size, st.st_mtime))
+    return tuple(identity)
+
+_digests = {} # {(path, size, mtime): digest}, for compilerDigest()
+
+def compilerDigest(compiler=None):
+    """What the compiler is wherever it was installed: compilerIdentity()
+    with each file replaced by a digest of its contents, so that the same
+    compiler installed at another path or time is the same
+    """
+    digest = []
+    for arg, size, mtime in compilerIdentity(compiler):
+        if size is None or not os.path.isfile(arg):
+            digest.append(arg)
+            continue
+        key = (arg, size, mtime)
+        if key not in _digests:
+            _digests[key] = fileDigest(arg)
+        digest.append(_digests[key])
+    return tuple(digest)
+
+def build(script, compiler=None):
+    """Compile script with iscc, or with compiler, a command to run with
+    the script's name after it, such as (sys.executable, 'fakeiscc.py')
+    """
+    if compiler is None:
+        compiler = (iscc,)
+    po = ProcessOpen(tuple(compiler) + (script,))
     print po.stdout.read()
     status = po.wait()
     assert status==0
+
+class BuildError(Exception):
+    """The compiler failed on script, exiting with status after writing
+    output
+    """
+    def __init__(self, script, status, output):
+        Exception.__init__(self, script, status, output)
+        self.script = script
+        self.status = status
+        self.output = output
+
+    def __str__(self):
+        return "compiling %s failed with status %d" % (self.script,
+                                                       self.status)
+
+def runCompiler(script, compiler=None):
+    """Like build(), but return what the compiler wrote instead of
+    printing it, and raise BuildError if it fails
+    """
+    if compiler is None:
+        compiler = (iscc,)
+    # one pipe for both, read to the end: reading stdout and then stderr
+    # stalls once the compiler fills the stderr pipe
+    po = subprocess.Popen(list(compiler) + [script], stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = po.communicate()[0]
+    if po.returncode != 0:
+        raise BuildError(script, po.returncode, output)
+    return output
+
+def cpuCount():
+    """How many processors there are, or 1 if that cannot be found out"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    try:
+        return max(int(os.sysconf('SC_NPROCESSORS_ONLN')), 1)
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        return max(int(os.environ['NUMBER_OF_PROCESSORS']), 1)
+    except (KeyError, ValueError):
+        return 1
+
+class BuildResult:
+    """What building one job of buildMany() came to: the installer (for
+    a Script) or None, the compiler's output, the Script's BuildReport if
+    any, and error, which is None unless the build failed
+    """
+    def __init__(self, job):
+        self.job = job
+        self.name = getattr(job, 'name', job)
+        self.installer = None
+        self.output = ''
+        self.report = None
+        self.error = None
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return "<BuildResult %r>" % (self.name,)
+
+    def failed(self):
+        return self.error is not None
+
+    def __str__(self):
+        if self.error is not None:
+            state = 'FAILED: %s' % self.error.strip().splitlines()[-1]
+        elif self.report is not None and self.report.hit:
+            state = 'up to date'
+        elif self.report is not None and self.report.fetched:
+            state = 'fetched'
+        else:
+            state = 'built'
+        return "%-30s %7.1fs  %s" % (self.name, self.seconds, state)
+
+def _buildOne(job, compiler, force):
+    """Build job, never raising; return its BuildResult"""
+    result = BuildResult(job)
+    start = time.time()
+    outputs = []
+    def capture(script, compiler):
+        outputs.append(runCompiler(script, compiler))
+    try:
+        try:
+            if hasattr(job, 'compile'):
+                result.installer = job.compile(force=force, build=capture)
+                result.report = job.buildReport
+            else:
+                capture(job, compiler)
+        except BuildError, e:
+            outputs.append(e.output)
+            result.error = str(e)
+        except:
+            result.error = ''.join(traceback.format_exception(
+                *sys.exc_info()))
+    finally:
+        result.output = ''.join(outputs)
+        result.seconds = time.time() - start
+    return result
+
+def buildMany(scripts, jobs=None, compiler=None, force=0):
+    """Build scripts, inno.Script instances or the names of .iss files,
+    jobs at a time (one per processor by default), and return a
+    BuildResult for each, in order.  A failure does not stop the others;
+    check each result's failed().  Scripts are compiled as their
+    compile() does, with force passed on; .iss files are handed to
+    compiler (see build()).
+    """
+    if jobs is None:
+        jobs = cpuCount()
+    pool = WorkerPool(max(jobs, 1))
+    started = [pool.submit(_buildOne, job, compiler, force)
+               for job in scripts]
+    return [job.result() for job in started]
+
+def summarize(results, elapsed=None):
+    """A report on the BuildResults of buildMany(): a line per job, the
+    output of those that failed, and the totals
+    """
+    lines = [str(r) for r in results]
+    failed = [r for r in results if r.failed()]
+    for r in failed:
+        lines.append('')
+        lines.append('--- %s' % r.name)
+        lines.append(r.output.rstrip())
+        lines.append(r.error.rstrip())
+    work = sum([r.seconds for r in results])
+    total = "%d succeeded, %d failed, %.1fs of work" % (
+        len(results) - len(failed), len(failed), work)
+    if elapsed is not None:
+        total = total + " in %.1fs" % elapsed
+    lines.append('')
+    lines.append(total)
+    return '\n'.join(lines)
+
+def main(argv=None):
+    """Compile the .iss files named on the command line in parallel,
+    reporting on all of them; exit with 1 if any failed
+    """
+    parser = OptionParser(usage="%prog [options] script.iss ...")
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help="compilers to run at once [one per processor]")
+    parser.add_option('-c', '--compiler', default=None,
+                      help="command to run instead of iscc, split on spaces")
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help="show the compiler's output for every script")
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("no scripts to build")
+    compiler = None
+    if options.compiler:
+        compiler = options.compiler.split()
+    start = time.time()
+    results = buildMany(args, options.jobs, compiler)
+    if options.verbose:
+        for r in results:
+            if not r.failed():
+                print '--- %s' % r.name
+                print r.output.rstrip()
+    print summarize(results, time.time() - start)
+    for r in results:
+        if r.failed():
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
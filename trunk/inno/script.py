@@ -7,7 +7,14 @@ import types
 
 # local imports
 from inno.path import path
-from inno.fmlang import FileMapperParser
+from inno.fmlang import scriptSources, describeItems
+from inno.fmcache import ManifestCache
+from inno.dirwalk import DirWalker, FILE, DIR
+from inno.watch import ManifestWatcher
+from inno.dedupe import dedupe as dedupeItems
+from inno.collapse import collapse
+from inno.buildstate import BuildState
+from inno.artifacts import ArtifactCache, artifactKey, MAX_BYTES
 import inno
 
 
@@ -36,6 +43,15 @@ def accumulateMethods(obj, dict, prefix='', curClass=None):
             and (len(optName))):
             dict[optName] = getattr(obj, name)
 
+def destName(dest, src):
+    """The DestName parameter for a [Files] entry, needed only when the
+    file is installed under a different name than its source's
+    """
+    name = path(dest).basename()
+    if name == path(src).basename():
+        return ''
+    return '; DestName: "%s"' % name
+
 class Script:
     """A scriptable inno setup script (.iss).
     >>> from inno import Script
@@ -43,27 +59,123 @@ class Script:
     package_version=\"1.0\")
     >>> s.collect(\"myprogram\") # add files to the package
     >>> s.compile() # run inno on the package
+
+    Directory trees installed whole get one recursive [Files] entry each
+    (see inno.collapse), unless the collapse option is false.
     """
     _required = ('display_name', 'name', 'package_version',)
     def __init__(self, **options):
         for a in self._required: setattr(self, a, options[a])
         self.uninstallable = options.get('uninstallable', 1)
+        self.collapse = options.get('collapse', 1)
         if not options.get('destination', None):
             options['destination'] = r"{pf}\%(name)s" % options
         self._options = options
         self.sources = []
         self.fmscript = None
+        self.watcher = None
+        self.walker = None # what the sources were read through
+        self.dedupeWorkers = None
+        self.dedupeReport = None
+        self.collapsed = {}
+        self.collapseReport = None
+        self.buildReport = None
 
     def runFileCommands(self):
         """Process self.fmscript as a FileMapper script (fmlang.py),
-        storing the result in self.sources
+        storing the result in self.sources, a list of fmlang.Source
+        records, so that writing the script needs nothing from the disk.
+        With the manifest_cache option set to a filename, the result is
+        kept there between builds.
         """
-        fmp = FileMapperParser()
-        for line in self.fmscript.split('\n'):
-            fmp.onecmd(line)
-        
-        self.sources = fmp.data.items()
-        
+        if self.watcher is not None:
+            if self.watcher.fmscript != self.fmscript:
+                self.watch(self.watcher.polling)
+            self.sources = describeItems(self.watcher.snapshot())
+            walker = self.watcher.walker
+        else:
+            cachefile = self._options.get('manifest_cache', None)
+            if cachefile is None:
+                walker = DirWalker()
+                walker.mtimes = {} # for checking collapsed trees later
+                self.sources = scriptSources(self.fmscript, walker=walker)
+            else:
+                cache = ManifestCache(cachefile)
+                items = cache.run(self.fmscript)
+                walker = cache.walker
+                self.sources = describeItems(items, walker)
+        self.walker = walker
+        if self.dedupeWorkers is not None:
+            self._dedupe()
+        self._collapse(walker)
+
+    def dedupe(self, workers=4):
+        """From now on, install files with the same contents from one
+        source, so ISCC compresses them once.  Returns (and keeps in
+        dedupeReport) an inno.dedupe.DedupeReport of what was merged.
+        """
+        self.dedupeWorkers = workers
+        self._dedupe()
+        self._collapse(self.walker)
+        return self.dedupeReport
+
+    def _dedupe(self):
+        items, self.dedupeReport = dedupeItems(self.sources,
+                                               self.dedupeWorkers)
+        self.sources = [s.withSource(src)
+                        for s, (dest, src) in zip(self.sources, items)]
+
+    def _collapse(self, walker=None, avoid=()):
+        """Find the trees in self.sources that can be installed whole,
+        other than any holding a directory in avoid or one the build
+        writes to, keeping an inno.collapse.CollapseReport in
+        collapseReport
+        """
+        if self.collapse:
+            avoid = list(avoid) + self._buildDirs()
+            self.collapsed, self.collapseReport = collapse(self.sources,
+                                                           walker, avoid)
+        else:
+            self.collapsed, self.collapseReport = {}, None
+
+    def _buildDirs(self):
+        """The directories building writes to: the installer, the .iss,
+        the build state and the caches go there
+        """
+        files = [self.outputPath(), "%s.iss" % self.name,
+                 self._buildStatePath()]
+        if self._options.get('manifest_cache', None):
+            files.append(self._options['manifest_cache'])
+        dirs = [os.path.dirname(os.path.abspath(f)) for f in files]
+        dirs.append(tempfile.gettempdir()) # for compile(temporary=1)
+        if self._options.get('artifact_cache', None):
+            dirs.append(self._options['artifact_cache'])
+        return dirs
+
+    def _recollapse(self):
+        """Collapse again without the directories that changed since the
+        trees were found, as ISCC would install whatever is there now
+        """
+        if self.collapseReport is None:
+            return
+        changed = []
+        for tree in self.collapseReport.subtrees:
+            changed.extend(tree.changed())
+        if changed:
+            self._collapse(self.walker, changed)
+
+    def watch(self, polling=0):
+        """Keep the collected files current from now on: each compile()
+        picks up files added, removed or renamed since the last one
+        without walking the whole tree again.  See inno.watch.  Raises
+        ValueError if nothing was collected yet.
+        """
+        if self.fmscript is None:
+            raise ValueError("nothing to watch: collect() something first")
+        if self.watcher is not None:
+            self.watcher.close()
+        self.watcher = ManifestWatcher(self.fmscript, polling=polling)
+        self.runFileCommands()
 
     def collect(self, src, recurse=1, empties=1, exclude_globs=()):
         """Add files in src as contents of the Inno package.
@@ -81,7 +193,8 @@ packaged
         do = scx.append
 
         do("""\
-# Commands: add chdir diradd exclude show unexclude
+# Commands: add chdir diradd exclude profile show unexclude
+# Use "profile on" to record what each command costs, "profile" to print it
 # Use "add **/*" to add recursively (recursive in subdirectories works
 #   too)
 """)
@@ -126,22 +239,37 @@ OutputDir=%(workdir)s
         
 
     def _section_Files(self, fd):
-        w = fd.write
-        w("[Files]\n")
+        fd.write("[Files]\n")
+        self._writeFiles(fd, "{app}")
 
-        tmpl = 'Source: "%s"; DestDir: "{app}\%s"; Flags: ignoreversion\n'
-        for dest, src in self.sources:
-            if path(src).isfile():
-                w(tmpl % (src, path(dest).dirname()))
+    def _writeFiles(self, fd, root):
+        """Write a [Files] line for each file in self.sources, or for the
+        Subtree it is in, installing under root
+        """
+        w = fd.write
+        tmpl = 'Source: "%s"; DestDir: "%s\\%s"%s; Flags: ignoreversion\n'
+        treeTmpl = ('Source: "%s"; DestDir: "%s\\%s"; '
+                    'Flags: ignoreversion %s\n')
+        written = {}
+        for s in self.sources:
+            if s.kind != FILE:
+                continue
+            tree = self.collapsed.get(s.dest)
+            if tree is None:
+                w(tmpl % (s.src, root, path(s.dest).dirname(),
+                          destName(s.dest, s.src)))
+            elif tree.src not in written:
+                written[tree.src] = 1
+                w(treeTmpl % (tree.pattern(), root, tree.dest, tree.flags()))
 
     def _section_Dirs(self, fd):
         w = fd.write
         w("[Dirs]\n")
 
         tmpl = 'Name: "{app}\%s"\n'
-        for dest, src in self.sources:
-            if path(src).isdir():
-                w(tmpl % dest)
+        for s in self.sources:
+            if s.kind == DIR and s.dest not in self.collapsed:
+                w(tmpl % s.dest)
 
     def _section_Icons(self, fd):
         w = fd.write
@@ -150,18 +278,96 @@ OutputDir=%(workdir)s
             w('Name: "{group}\Uninstall %s"; Filename: "{uninstallexe}"\n' %
               self.display_name)
 
-    def compile(self, temporary=0):
-        """Generate the script file and send it to iscc
+    def outputPath(self):
+        """Where iscc puts the installer"""
+        name = "%(name)s-%(package_version)s-setup.exe" % self._options
+        return os.path.join(os.getcwd(), name)
+
+    def _buildStatePath(self):
+        return self._options.get('build_state', "%s.buildstate" % self.name)
+
+    def compile(self, temporary=0, force=0, build=None):
+        """Generate the script file and send it to iscc, unless the script,
+        the compiler and every source file are as they were for the last
+        build and its installer is still there.  That build is recorded in
+        the file named by the build_state option, <name>.buildstate by
+        default; the content_hash option also compares the contents of
+        files whose mtime moved (see inno.buildstate).  With the
+        artifact_cache option naming a directory, installers are shared
+        through it with other builders (see inno.artifacts), keeping at
+        most artifact_cache_size bytes there; they are fetched by copy,
+        or with artifact_link by hard link, in which case the installer
+        must not be changed in place.  The compiler option is a
+        command to run instead of iscc (see inno.runner.build).  Returns
+        the path of the installer, and keeps a BuildReport in buildReport.
         @param temporary: use a temp file for the iss
+        @param force: build even if nothing changed
+        @param build: what to call instead of inno.build, with the names
+        of the .iss and the compiler
         """
+        if self.watcher is not None:
+            self.runFileCommands()
+        else:
+            self._recollapse()
+        text = StringIO()
+        self.writeScript(text)
+        text = text.getvalue()
+        output = self.outputPath()
+        compiler = self._options.get('compiler', None)
+        artifacts = self._options.get('artifact_cache', None)
+        if artifacts is not None:
+            artifacts = ArtifactCache(artifacts,
+                                      self._options.get('artifact_cache_size',
+                                                        MAX_BYTES))
+        # the artifact key needs the contents of the sources
+        contentHash = self._options.get('content_hash', 0) or artifacts
+        state = BuildState(self._buildStatePath(), contentHash)
+        identity = inno.runner.compilerIdentity(compiler)
+        self.buildReport = report = state.check(text, identity,
+                                                self.sources, output)
+        if report.hit and not force:
+            if state.new['sources'] != state.state['sources']:
+                state.save() # new digests worth keeping
+            return output
+        if force and report.hit:
+            report.hit = 0
+            report.reasons.append('forced')
+        key = None
+        if artifacts is not None:
+            key = artifactKey(text, inno.runner.compilerDigest(compiler),
+                              state.new['sources'], os.getcwd())
+            link = self._options.get('artifact_link', 0)
+            if (key is not None and not force
+                and artifacts.fetch(key, output, link)):
+                report.fetched = 1
+                state.save()
+                return output
+            if os.path.exists(output):
+                # it may be a link to an installer in the cache
+                os.remove(output)
         if temporary:
-            out = tempfile.NamedTemporaryFile(suffix='.iss', mode='w+')
+            # closed before iscc runs, which cannot open a file still
+            # open here on win32
+            fd, name = tempfile.mkstemp(suffix='.iss')
+            out = os.fdopen(fd, 'w')
         else:
-            out = file("%s.iss" % self.name, 'w+')
-        name = out.name
-        self.writeScript(out)
-        out.close()
-        inno.build(name)
+            name = "%s.iss" % self.name
+            out = file(name, 'w')
+        try:
+            out.write(text)
+        finally:
+            out.close()
+        if build is None:
+            build = inno.build
+        try:
+            build(name, compiler)
+        finally:
+            if temporary:
+                os.remove(name)
+        if key is not None:
+            artifacts.publish(key, output)
+        state.save()
+        return output
 
 class PythonScript(Script):
     def _section_Types(self, fd):
@@ -187,13 +393,8 @@ NoUninstallWarning=Setup has detected that this package has already been install
 ''')
 
     def _section_Files(self, fd):
-        w = fd.write
-        w("[Files]\n")
-
-        tmpl = 'Source: "%s"; DestDir: "{code:SiteLib}\%s"; Flags: ignoreversion\n'
-        for dest, src in self.sources:
-            if path(src).isfile():
-                w(tmpl % (src, path(dest).dirname()))
+        fd.write("[Files]\n")
+        self._writeFiles(fd, "{code:SiteLib}")
 
     def _section_Setup(self, fd):
         Script._section_Setup(self, fd)
@@ -0,0 +1,261 @@
+"""A manifest kept in an SQLite database, for trees whose manifest will
+not fit in memory even as an fmlang.CompactManifest.
+
+SQLiteManifest has the mapping interface and ordering rules of
+fmlang.OrderedDict, so it can stand in for FileMapperParser.data:
+
+>>> fmp = FileMapperParser(retain=0)
+>>> fmp.data = SQLiteManifest('big.manifest')
+>>> fmp.runScript(fmscript)
+
+and adds a few queries that are cheap in SQL: the files under a
+destination directory, the total size of each destination directory,
+and sources mapped to more than one destination.  With retain=0 the
+parser does not keep the directory listings either, so memory does not
+grow with the tree at all.
+
+Needs the sqlite3 module (Python 2.5 and later) or pysqlite2.
+"""
+import os
+import tempfile
+from UserDict import DictMixin
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    seq INTEGER PRIMARY KEY,
+    dest TEXT NOT NULL UNIQUE,
+    destdir TEXT NOT NULL,
+    src TEXT NOT NULL,
+    srcdir TEXT NOT NULL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS manifest_destdir ON manifest (destdir);
+CREATE INDEX IF NOT EXISTS manifest_srcdir ON manifest (srcdir);
+"""
+
+
+def _dirname(p):
+    """p up to its last separator; a directory destination (which ends
+    with one) is its own directory
+    """
+    i = p.rfind(os.sep)
+    if i < 0:
+        return ''
+    return p[:i]
+
+
+class SQLiteManifest(DictMixin):
+    """An ordered mapping of destination to source paths in the SQLite
+    database filename, or in a temporary file removed by close() if
+    filename is None.  Whatever the database held is dropped unless
+    fresh is false.  Changes are committed every batchSize of them, by
+    update() and by commit().
+    """
+    batchSize = 10000
+
+    def __init__(self, filename=None, fresh=1):
+        if sqlite3 is None:
+            raise ImportError("SQLiteManifest needs sqlite3 or pysqlite2")
+        self.temporary = filename is None
+        if self.temporary:
+            fd, filename = tempfile.mkstemp(suffix='.manifest')
+            os.close(fd)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+        if fresh:
+            self.db.execute("DELETE FROM manifest")
+            self.db.commit()
+        self._len = self.db.execute(
+            "SELECT COUNT(*) FROM manifest").fetchone()[0]
+        self._pending = 0
+
+    def _changed(self, n=1):
+        self._pending = self._pending + n
+        if self._pending >= self.batchSize:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self._pending = 0
+
+    def close(self):
+        """Commit and close the database, removing it if temporary"""
+        if self.db is None:
+            return
+        self.commit()
+        self.db.close()
+        self.db = None
+        if self.temporary:
+            os.remove(self.filename)
+
+    def __getitem__(self, k):
+        row = self.db.execute("SELECT src FROM manifest WHERE dest = ?",
+                              (k,)).fetchone()
+        if row is None:
+            raise KeyError(k)
+        return row[0]
+
+    def __contains__(self, k):
+        return self.db.execute("SELECT 1 FROM manifest WHERE dest = ?",
+                               (k,)).fetchone() is not None
+    has_key = __contains__
+
+    def __len__(self):
+        return self._len
+
+    def __setitem__(self, k, v):
+        # same rules as OrderedDict: a new value moves k to the end
+        try:
+            old = self[k]
+        except KeyError:
+            pass
+        else:
+            if old == v:
+                return
+            del self[k]
+        self.db.execute("INSERT INTO manifest (dest, destdir, src, srcdir) "
+                        "VALUES (?, ?, ?, ?)", (k, _dirname(k), v, _dirname(v)))
+        self._len = self._len + 1
+        self._changed()
+
+    def __delitem__(self, k):
+        c = self.db.execute("DELETE FROM manifest WHERE dest = ?", (k,))
+        if c.rowcount == 0:
+            raise KeyError(k)
+        self._len = self._len - 1
+        self._changed()
+
+    def update(self, d):
+        """Set every item of d, in one transaction"""
+        items = d.items()
+        db = self.db
+        # what is there with a different source moves to the end, what is
+        # there with the same one stays put
+        c = db.executemany("DELETE FROM manifest WHERE dest = ? AND src <> ?",
+                           items)
+        self._len = self._len - max(c.rowcount, 0)
+        c = db.executemany("INSERT OR IGNORE INTO manifest "
+                           "(dest, destdir, src, srcdir) VALUES (?, ?, ?, ?)",
+                           [(k, _dirname(k), v, _dirname(v))
+                            for k, v in items])
+        self._len = self._len + max(c.rowcount, 0)
+        self.commit()
+
+    def clear(self):
+        self.db.execute("DELETE FROM manifest")
+        self._len = 0
+        self.commit()
+
+    def __iter__(self):
+        for row in self.db.execute("SELECT dest FROM manifest ORDER BY seq"):
+            yield row[0]
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for row in self.db.execute("SELECT src FROM manifest ORDER BY seq"):
+            yield row[0]
+
+    def iteritems(self):
+        return iter(self.db.execute(
+            "SELECT dest, src FROM manifest ORDER BY seq"))
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.filename)
+
+    def copy(self):
+        """A new temporary SQLiteManifest with the same items"""
+        other = self.__class__()
+        other.db.executemany(
+            "INSERT INTO manifest (dest, destdir, src, srcdir) "
+            "VALUES (?, ?, ?, ?)",
+            [(k, _dirname(k), v, _dirname(v)) for k, v in self.iteritems()])
+        other._len = self._len
+        other.commit()
+        return other
+
+    def popitem(self):
+        row = self.db.execute("SELECT dest, src FROM manifest "
+                              "ORDER BY seq LIMIT 1").fetchone()
+        if row is None:
+            raise KeyError('popitem(): dictionary is empty')
+        del self[row[0]]
+        return row
+
+    # queries
+
+    def filesUnder(self, destdir, recurse=1):
+        """The (destination, source) items of files in destdir, and in
+        the directories below it if recurse, in order
+        """
+        query = ("SELECT dest, src FROM manifest WHERE "
+                 "(destdir = ?%s) AND dest <> destdir || ? ORDER BY seq")
+        if recurse:
+            # every destdir starting with destdir + os.sep sorts between
+            # it and destdir followed by the character after os.sep
+            below = destdir + os.sep
+            after = destdir + chr(ord(os.sep) + 1)
+            cond = " OR (destdir >= ? AND destdir < ?)"
+            args = (destdir, below, after, os.sep)
+        else:
+            cond = ""
+            args = (destdir, os.sep)
+        return self.db.execute(query % cond, args).fetchall()
+
+    def fillSizes(self):
+        """Stat the sources whose size is not yet known"""
+        rows = self.db.execute(
+            "SELECT seq, src FROM manifest WHERE size IS NULL").fetchall()
+        sizes = []
+        for seq, src in rows:
+            try:
+                sizes.append((os.path.getsize(src), seq))
+            except OSError:
+                sizes.append((0, seq))
+        self.db.executemany("UPDATE manifest SET size = ? WHERE seq = ?",
+                            sizes)
+        self.commit()
+
+    def sizeByDir(self):
+        """[(destination directory, total bytes of the files directly in
+        it)], for every directory holding files
+        """
+        self.fillSizes()
+        return self.db.execute(
+            "SELECT destdir, SUM(size) FROM manifest "
+            "WHERE dest <> destdir || ? "
+            "GROUP BY destdir ORDER BY destdir", (os.sep,)).fetchall()
+
+    def duplicates(self):
+        """[(source, [destination, ...])] for every source that is mapped
+        to more than one destination
+        """
+        result = []
+        rows = self.db.execute(
+            "SELECT src, dest FROM manifest WHERE src IN "
+            "(SELECT src FROM manifest GROUP BY src HAVING COUNT(*) > 1) "
+            "ORDER BY src, seq")
+        for src, dest in rows:
+            if result and result[-1][0] == src:
+                result[-1][1].append(dest)
+            else:
+                result.append((src, [dest]))
+        return result
@@ -0,0 +1,427 @@
+"""Benchmarks for inno.fmlang.  Not run by trial; use
+python -m inno.test.bench_fmlang <benchmark> [args]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from inno import fmlang
+from inno.fmlang import FileMapperParser
+from inno.fmcache import ManifestCache
+
+
+def makeTree(root, nfiles, fanout=10, perdir=1000):
+    """Create a synthetic tree under root holding nfiles empty files,
+    perdir files to a directory, fanout directories to a level
+    """
+    made = 0
+    ndirs = (nfiles + perdir - 1) // perdir
+    for n in range(ndirs):
+        parts = []
+        i = n
+        while 1:
+            parts.insert(0, 'd%d' % (i % fanout))
+            i = i // fanout
+            if i == 0:
+                break
+        d = os.path.join(root, *parts)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        for f in range(min(perdir, nfiles - made)):
+            open(os.path.join(d, 'f%d.dat' % f), 'w').close()
+        made = made + min(perdir, nfiles - made)
+    return made
+
+
+class SyscallCounter:
+    """Count calls to the os functions that hit the filesystem while
+    installed
+    """
+    names = ('listdir', 'stat', 'lstat', 'getcwd', 'scandir')
+
+    def __init__(self):
+        self.counts = {}
+        self.saved = {}
+
+    def install(self):
+        for name in self.names:
+            if hasattr(os, name):
+                self.saved[name] = getattr(os, name)
+                setattr(os, name, self._wrap(name, self.saved[name]))
+
+    def uninstall(self):
+        for name, func in self.saved.items():
+            setattr(os, name, func)
+        self.saved = {}
+
+    def _wrap(self, name, func):
+        counts = self.counts
+        def counted(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return func(*args, **kwargs)
+        return counted
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+def benchWalk(nfiles=100000):
+    """Collect a synthetic tree with "add **/*" and then "diradd **/*",
+    and report the syscalls spent per entry on each
+    """
+    nfiles = int(nfiles)
+    root = tempfile.mkdtemp(prefix='fmbench')
+    try:
+        makeTree(root, nfiles)
+        fmp = FileMapperParser()
+        fmp.onecmd("chdir '%s'" % root)
+        for line in ("add **/*", "diradd **/*"):
+            counter = SyscallCounter()
+            counter.install()
+            try:
+                start = time.time()
+                fmp.onecmd(line)
+                elapsed = time.time() - start
+            finally:
+                counter.uninstall()
+            print "%s: %.2fs" % (line, elapsed)
+            for name in counter.names:
+                if name in counter.counts:
+                    print "%12s: %8d" % (name, counter.counts[name])
+            print "syscalls per entry: %.3f" % (
+                float(counter.total()) / max(fmp.walker.stats.entries, 1))
+    finally:
+        shutil.rmtree(root)
+
+
+def benchOrderedDict(*sizes):
+    """Time inserting, replacing, re-setting, deleting and listing the
+    items of fmlang.OrderedDicts of several sizes
+    """
+    sizes = [int(n) for n in sizes] or [10000, 100000, 1000000]
+    print "%9s %9s %9s %9s %9s %9s" % ('keys', 'insert', 'replace',
+                                       'same', 'delete', 'items')
+    for n in sizes:
+        keys = ['.\\dir%d\\file%d' % (i % 100, i) for i in range(n)]
+        times = []
+        d = fmlang.OrderedDict()
+        start = time.time()
+        for k in keys:
+            d[k] = k
+        times.append(time.time() - start)
+        start = time.time()
+        for k in keys[::2]:
+            d[k] = 'replaced'
+        times.append(time.time() - start)
+        start = time.time()
+        for k in keys[::2]:
+            d[k] = 'replaced'
+        times.append(time.time() - start)
+        start = time.time()
+        for k in keys[1::2]:
+            del d[k]
+        times.append(time.time() - start)
+        start = time.time()
+        d.items()
+        times.append(time.time() - start)
+        print "%9d %8.3fs %8.3fs %8.3fs %8.3fs %8.3fs" % tuple([n] + times)
+
+
+class SlowFilesystem:
+    """Make os.listdir and os.stat sleep for latency seconds per call
+    while installed, like a filesystem on the far side of a network
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.saved = {}
+
+    def install(self):
+        for name in ('listdir', 'stat'):
+            self.saved[name] = getattr(os, name)
+            setattr(os, name, self._wrap(self.saved[name]))
+
+    def uninstall(self):
+        for name, func in self.saved.items():
+            setattr(os, name, func)
+        self.saved = {}
+
+    def _wrap(self, func):
+        latency = self.latency
+        def slow(*args):
+            time.sleep(latency)
+            return func(*args)
+        return slow
+
+
+def benchParallel(nfiles=4000, latency=0.002, *workers):
+    """Collect a synthetic tree with "add **/*" through a filesystem with
+    latency seconds per call, reading with various numbers of workers
+    """
+    nfiles = int(nfiles)
+    workers = [int(w) for w in workers] or [0, 4, 16, 64]
+    root = tempfile.mkdtemp(prefix='fmbench')
+    try:
+        makeTree(root, nfiles, perdir=50)
+        slow = SlowFilesystem(float(latency))
+        expected = None
+        for n in workers:
+            fmp = FileMapperParser(workers=n)
+            fmp.onecmd("chdir '%s'" % root)
+            slow.install()
+            try:
+                start = time.time()
+                fmp.onecmd("add **/*")
+                elapsed = time.time() - start
+            finally:
+                slow.uninstall()
+            items = fmp.data.items()
+            if expected is None:
+                expected = items
+            same = (items == expected) and 'same' or 'DIFFERENT'
+            print "%3d workers: %d files in %.2fs (%s order)" % (
+                n, len(items), elapsed, same)
+    finally:
+        shutil.rmtree(root)
+
+
+def benchCache(nfiles=100000):
+    """Run "add **/*" over a synthetic tree through a ManifestCache: cold,
+    with nothing changed, and after adding a file to one directory
+    """
+    nfiles = int(nfiles)
+    root = tempfile.mkdtemp(prefix='fmbench')
+    try:
+        tree = os.path.join(root, 'tree')
+        makeTree(tree, nfiles)
+        cachefile = os.path.join(root, 'bench.fmcache')
+        script = "chdir '%s'\nadd **/*" % tree
+        # directories modified just now are never trusted, so backdate
+        old = time.time() - 3600
+        for d, dirs, files in os.walk(tree):
+            os.utime(d, (old, old))
+        for label in ('cold', 'unchanged', 'one changed'):
+            if label == 'one changed':
+                changed = os.path.join(tree, 'd0')
+                open(os.path.join(changed, 'new.dat'), 'w').close()
+                os.utime(changed, (old + 1, old + 1))
+            start = time.time()
+            cache = ManifestCache(cachefile)
+            items = cache.run(script)
+            elapsed = time.time() - start
+            listed = 0
+            if not cache.hit:
+                listed = cache.stats.listed
+            print "%12s: %d files in %.3fs, %d directories listed" % (
+                label, len(items), elapsed, listed)
+    finally:
+        shutil.rmtree(root)
+
+
+def benchLiteral(nfiles=50000, nlines=100):
+    """Add nlines single files by name from one directory of nfiles, once
+    by plain name and once through a wildcard that still matches just
+    that name, which has to read the directory
+    """
+    nfiles, nlines = int(nfiles), int(nlines)
+    root = tempfile.mkdtemp(prefix='fmbench')
+    try:
+        big = os.path.join(root, 'big')
+        os.mkdir(big)
+        for n in range(nfiles):
+            open(os.path.join(big, 'f%d.dat' % n), 'w').close()
+        step = max(nfiles // nlines, 1)
+        wanted = range(0, nfiles, step)[:nlines]
+        for label, pattern in (('literal', 'big/f%d.dat'),
+                               ('wildcard', 'big/f%d.da[t]')):
+            script = '\n'.join(["chdir '%s'" % root] +
+                               ["add %s" % (pattern % n) for n in wanted])
+            fmlang.scriptCache.clear()
+            fmp = FileMapperParser()
+            start = time.time()
+            fmp.runScript(script)
+            elapsed = time.time() - start
+            stats = fmp.walker.stats
+            print "%9s: %d files in %.3fs, %d directories listed, " \
+                  "%d names looked up" % (label, len(fmp.data), elapsed,
+                                          stats.listed, stats.probed)
+    finally:
+        shutil.rmtree(root)
+
+
+def benchParse(nlines=50000):
+    """Parse a generated fmscript of nlines add commands with the old
+    shlex-per-line parseline and with FileMapperParser.compileScript, the
+    second time from fmlang.scriptCache
+    """
+    nlines = int(nlines)
+    lines = []
+    for n in range(nlines):
+        if n % 3 == 0:
+            lines.append("add 'dir %d/file %d.dat' # quoted" % (n // 100, n))
+        else:
+            lines.append("add dir%d/file%d.dat" % (n // 100, n))
+    script = '\n'.join(lines)
+    fmp = FileMapperParser()
+    def shlexParseline(line):
+        cmd, arg = fmlang._shlexTokens(line % fmp.replacements)
+        if arg[:1] in ('"', "'"):
+            arg = arg[1:-1]
+        line = ' '.join((cmd, arg))
+        pos = line.find(' ')
+        return line[:pos] or None, line[pos+1:] or None, line.strip()
+    start = time.time()
+    old = [shlexParseline(l) for l in script.splitlines()]
+    shlexTime = time.time() - start
+    fmlang.scriptCache.clear()
+    start = time.time()
+    new = fmp.compileScript(script)
+    newTime = time.time() - start
+    start = time.time()
+    fmp.compileScript(script)
+    cachedTime = time.time() - start
+    print "%d lines: shlex %.3fs, compileScript %.3fs, again %.3fs (%s)" % (
+        nlines, shlexTime, newTime, cachedTime,
+        (old == new) and 'same' or 'DIFFERENT')
+
+
+def deepSize(obj):
+    """The bytes sys.getsizeof counts for obj and everything it refers to,
+    each object counted once
+    """
+    seen = {}
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen[id(obj)] = 1
+        size = size + sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return size
+
+
+def benchMemory(*sizes):
+    """Compare the memory taken by an fmlang.OrderedDict and an
+    fmlang.CompactManifest holding the same synthetic manifest
+    """
+    sizes = [int(n) for n in sizes] or [100000, 1000000]
+    sep = os.sep
+    root = sep.join(['', 'builds', 'sdk-9.1', 'stage'])
+    print "%9s %20s %20s" % ('entries', 'OrderedDict', 'CompactManifest')
+    for n in sizes:
+        pairs = []
+        for i in xrange(n):
+            rel = sep.join(['include', 'lib%d' % (i // 5000),
+                            'sub%d' % (i // 200 % 25),
+                            'header_file_%d.h' % i])
+            pairs.append(('.' + sep + rel, root + sep + rel))
+        results = []
+        for cls in (fmlang.OrderedDict, fmlang.CompactManifest):
+            d = cls()
+            start = time.time()
+            for dest, src in pairs:
+                d[dest] = src
+            elapsed = time.time() - start
+            results.append((d, deepSize(d), elapsed))
+        if results[0][0].items() != results[1][0].items():
+            print "%9d DIFFERENT" % n
+            continue
+        print "%9d" % n,
+        for d, size, elapsed in results:
+            print "%7.1fM %4dB %5.2fs" % (size / 1048576.0, size // n,
+                                          elapsed),
+        print
+
+
+# the manifest stores benchParser() compares, and how to make a parser
+# with each.  A child process runs each, so that one's peak is not
+# another's.
+parserStores = ['none', 'iterMappings', 'dict', 'dict retain=0', 'compact',
+                'sqlite']
+
+def _parserPeak(tree, store):
+    """Collect tree into store in this process, and print how many items
+    it got, the peak resident size in bytes and the time taken
+    """
+    import resource
+    script = "chdir '%s'\nadd **/*" % tree
+    start = time.time()
+    if store == 'none':
+        n = 0 # the interpreter and the modules, for scale
+    elif store == 'iterMappings':
+        n = 0
+        for hit in fmlang.iterMappings(script):
+            n = n + 1
+    else:
+        if store == 'dict':
+            fmp = FileMapperParser()
+        elif store == 'dict retain=0':
+            fmp = FileMapperParser(retain=0)
+        elif store == 'compact':
+            fmp = FileMapperParser(compact=1)
+        elif store == 'sqlite':
+            from inno.sqlmanifest import SQLiteManifest
+            fmp = FileMapperParser(retain=0)
+            fmp.data = SQLiteManifest()
+        fmp.runScript(script)
+        n = len(fmp.data)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak = peak * 1024 # kilobytes, elsewhere
+    print n, peak, elapsed
+
+def benchParser(nfiles=200000):
+    """Collect a synthetic tree with "add **/*" into each manifest store
+    in turn, and report the peak memory of the whole process for each
+    """
+    import subprocess
+    nfiles = int(nfiles)
+    root = tempfile.mkdtemp(prefix='fmbench')
+    try:
+        tree = os.path.join(root, 'tree')
+        makeTree(tree, nfiles)
+        print "%14s %9s %9s %8s" % ('store', 'items', 'peak', 'time')
+        for store in parserStores:
+            child = subprocess.Popen([sys.executable, '-m',
+                                      'inno.test.bench_fmlang', '_peak',
+                                      tree, store],
+                                     stdout=subprocess.PIPE)
+            out = child.communicate()[0]
+            if child.returncode:
+                print "%14s failed" % store
+                continue
+            n, peak, elapsed = out.split()
+            print "%14s %9s %8.1fM %7.2fs" % (store, n,
+                                              int(peak) / 1048576.0,
+                                              float(elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+benchmarks = {'walk': benchWalk,
+              'parallel': benchParallel,
+              'ordereddict': benchOrderedDict,
+              'cache': benchCache,
+              'parse': benchParse,
+              'memory': benchMemory,
+              'literal': benchLiteral,
+              'parser': benchParser,
+              '_peak': _parserPeak,
+              }
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        names = [n for n in benchmarks if not n.startswith('_')]
+        print "usage: %s %s [args]" % (sys.argv[0], '|'.join(names))
+        sys.exit(2)
+    benchmarks[sys.argv[1]](*sys.argv[2:])
@@ -1,4 +1,7 @@
 import os
+import random
+import threading
+import Queue
 from cStringIO import StringIO
 
 from twisted.trial import unittest
@@ -6,6 +9,16 @@ from twisted.python import util
 from twisted.python.zipstream import unzip
 
 from inno.fmlang import FileMapperParser, DuplicateFileException, InvalidDirectoryException, sourceItems
+from inno.fmlang import compileGlob, ExclusionMatcher, gatherHits, matches
+from inno.fmlang import OrderedDict, iterMappings, iterSources
+from inno.fmlang import CompactManifest
+from inno.fmlang import splitLine, _shlexTokens
+from inno import fmlang
+from inno.dirwalk import DirWalker, StreamingWalker
+from inno.workers import WorkerPool
+from inno.fmcache import ManifestCache
+from inno.watch import ManifestWatcher
+from inno.sqlmanifest import SQLiteManifest
 
 class FMLangTestCase(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -14,6 +27,15 @@ class FMLangTestCase(unittest.TestCase):
     def setUp(self):
         zipf = util.sibpath(__file__, "data/test_fmlang.zip")
         unzip(zipf, overwrite=1)
+        # directories modified just now are never trusted by the caches
+        self.old = os.stat('.').st_mtime - 3600
+        self.backdate()
+
+    def backdate(self):
+        """Set every directory of the fixture to the same old mtime"""
+        for d, dirs, files in os.walk('.'):
+            os.utime(d, (self.old, self.old))
+
     def test_000collecting(self):
         self.fmp.replaceDuplicates = 1
         do = self.fmp.onecmd
@@ -173,6 +195,607 @@ add **/*
                     '.\\dir2\\z')
         self.assertEqual(actual, expected)
 
+    def test_005globMatcher(self):
+        """Globs are compiled once and match relative paths"""
+        g = compileGlob('**/*.py')
+        self.failUnless(g is compileGlob('**/*.py'))
+        self.failUnless(g.match('fmlang.py'))
+        self.failUnless(g.match(os.path.join('test', 'data', 'x.py')))
+        self.failIf(g.match('fmlang.pyc'))
+        g = compileGlob('dir/dir*/**/*')
+        self.failUnless(g.match(os.path.join('dir', 'dir2', 'x')))
+        self.failUnless(g.match(os.path.join('dir', 'dir3', 'a', 'b')))
+        self.failIf(g.match(os.path.join('dir', 'dir2')))
+        self.failIf(g.match(os.path.join('dir', 'x', 'y')))
+        self.failUnless(compileGlob('').match('anything'))
+
+    def test_006exclusionMatcher(self):
+        """Exclusions match the relative path or just the name"""
+        x = ExclusionMatcher(['CVS', '*.pyc', '*dir2*'])
+        self.failUnless(x(os.path.join('.', 'test', 'CVS'), 'CVS'))
+        self.failUnless(x(os.path.join('.', 'fmlang.pyc'), 'fmlang.pyc'))
+        self.failUnless(x(os.path.join('.', 'dir', 'dir2', 'x'), 'x'))
+        self.failIf(x(os.path.join('.', 'fmlang.py'), 'fmlang.py'))
+        self.failIf(ExclusionMatcher()(os.path.join('.', 'CVS'), 'CVS'))
+        fmp = FileMapperParser()
+        fmp.onecmd('exclude CVS')
+        x = fmp.excluder()
+        self.failUnless(x is fmp.excluder())
+        fmp.onecmd('unexclude CVS')
+        self.failIf(x is fmp.excluder())
+        self.failIf(fmp.excluder()(os.path.join('.', 'CVS'), 'CVS'))
+
+    def test_007pruning(self):
+        """Excluded directories are not descended by ** walks"""
+        walker = DirWalker()
+        hits = gatherHits('test', compileGlob('**/*'), ['CVS'], walker)
+        dests = [d for d, s, kind in hits]
+        self.failUnless(os.path.join('test', 'data', 'simple.iss') in dests)
+        self.failIf([d for d in dests if 'CVS' in d])
+        self.assertEqual(walker.stats.pruned, 2)
+        self.failIf(os.path.abspath(os.path.join('test', 'CVS'))
+                    in walker.listings)
+
+    def test_008orderedDict(self):
+        """Changed values move to the end, identical ones stay put"""
+        d = OrderedDict([('a', 1), ('b', 2), ('c', 3)])
+        d['a'] = 1
+        self.assertEqual(d.keys(), ['a', 'b', 'c'])
+        d['a'] = 4
+        self.assertEqual(d.items(), [('b', 2), ('c', 3), ('a', 4)])
+        del d['c']
+        self.assertEqual(d.items(), [('b', 2), ('a', 4)])
+        self.assertEqual(d.copy().items(), d.items())
+        self.assertEqual(d.popitem(), ('b', 2))
+        d.update(OrderedDict([('z', 0), ('y', 1)]))
+        self.assertEqual(list(d), ['a', 'z', 'y'])
+        d.clear()
+        self.assertEqual(d.items(), [])
+        self.assertRaises(KeyError, d.popitem)
+
+    def test_008orderedDictPop(self):
+        """pop() takes the key out of the order too"""
+        d = OrderedDict([('a', 1), ('b', 2)])
+        self.assertEqual(d.pop('a'), 1)
+        self.assertEqual(d.items(), [('b', 2)])
+        self.assertEqual(d.pop('a', None), None)
+        self.assertRaises(KeyError, d.pop, 'a')
+        d['a'] = 3
+        self.assertEqual(d.items(), [('b', 2), ('a', 3)])
+
+    def test_008orderedDictSetdefault(self):
+        """setdefault() adds a missing key at the end, and only then"""
+        d = OrderedDict([('a', 1)])
+        self.assertEqual(d.setdefault('b', 2), 2)
+        self.assertEqual(d.setdefault('a', 5), 1)
+        self.assertEqual(d.setdefault('c'), None)
+        self.assertEqual(d.items(), [('a', 1), ('b', 2), ('c', None)])
+        self.assertEqual(list(d), d.keys())
+
+    def test_009threads(self):
+        """Parsers in different threads do not disturb each other"""
+        roots = []
+        for n in range(12):
+            root = os.path.abspath('root%d' % n)
+            for d in range(n % 4 + 1):
+                os.makedirs(os.path.join(root, 'd%d' % d, 'CVS'))
+                for f in range(n + 1):
+                    open(os.path.join(root, 'd%d' % d, 'f%d' % f), 'w')
+                open(os.path.join(root, 'd%d' % d, 'CVS', 'Entries'), 'w')
+            roots.append(root)
+        def collect(root):
+            fmp = FileMapperParser()
+            for line in ("chdir '%s'" % root, "exclude CVS", "add **/*",
+                         "diradd **/*"):
+                fmp.onecmd(line)
+            return fmp.data.items()
+        expected = map(collect, roots)
+        here = os.getcwd()
+        jobs = Queue.Queue()
+        for i in range(len(roots)) * 4:
+            jobs.put(i)
+        results = []
+        def worker():
+            while 1:
+                try:
+                    i = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                results.append((i, collect(roots[i])))
+        threads = [threading.Thread(target=worker) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), len(roots) * 4)
+        for i, items in results:
+            self.assertEqual(items, expected[i])
+        self.assertEqual(os.getcwd(), here)
+
+    def test_010workers(self):
+        """Reading directories in threads gives the same results"""
+        script = ("exclude *.pyc", "add **/*", "diradd **/*")
+        fmp0, fmp8 = FileMapperParser(), FileMapperParser(workers=8)
+        for line in script:
+            fmp0.onecmd(line)
+            fmp8.onecmd(line)
+        self.assertEqual(fmp8.data.items(), fmp0.data.items())
+        # cmd.Cmd's arguments still come after the replacements
+        stdin = StringIO()
+        fmp = FileMapperParser({}, 'tab', stdin)
+        self.assertEqual((fmp.completekey, fmp.stdin), ('tab', stdin))
+        self.failIf(fmp.walker.pool)
+        pool = WorkerPool(4)
+        self.assertEqual(pool.map(len, ['', 'a', 'ab']), [0, 1, 2])
+        job = pool.submit(os.listdir, 'nosuchdir')
+        self.assertRaises(OSError, job.result)
+
+    def test_011listingCache(self):
+        """Listings are read once per session until invalidated"""
+        fmp = FileMapperParser()
+        fmp.replaceDuplicates = 1
+        fmp.onecmd("chdir dir")
+        fmp.onecmd("add **/*")
+        listed = fmp.walker.stats.listed
+        fmp.onecmd("diradd **/*")
+        fmp.onecmd("add dir2/*")
+        self.assertEqual(fmp.walker.stats.listed, listed)
+        open(os.path.join('dir', 'dir3', 'new'), 'w').close()
+        fmp.onecmd("add **/*")
+        self.failIf(os.path.join('.', 'dir3', 'new') in fmp.data)
+        fmp.invalidate('dir3')
+        fmp.onecmd("add **/*")
+        self.failUnless(os.path.join('.', 'dir3', 'new') in fmp.data)
+        self.assertEqual(fmp.walker.stats.listed, listed + 1)
+
+    def test_012planned(self):
+        """A planned script reads everything it needs up front and gives
+        the same results as running it line by line
+        """
+        script = """exclude *.pyc
+add LICENSE.*
+diradd program
+chdir test
+add **/*
+chdir ../dir
+exclude *dir2*
+add **/*
+unexclude *dir2*
+diradd **/*"""
+        fmp = FileMapperParser()
+        fmp.replaceDuplicates = 1
+        for line in script.splitlines():
+            fmp.onecmd(line)
+        planned = FileMapperParser()
+        planned.replaceDuplicates = 1
+        commands = planned.compileScript(script)
+        plans = planned.planScript(commands)
+        self.assertEqual([root for root, plan in plans],
+                         [os.getcwd(), os.path.abspath('test'),
+                          os.path.abspath('dir')])
+        planned.runScript(script)
+        self.assertEqual(planned.data.items(), fmp.data.items())
+        self.assertEqual(planned.walker.stats.listed,
+                         fmp.walker.stats.listed)
+
+    def test_013manifestCache(self):
+        """A cached script is answered without listing anything until a
+        directory changes, and then only that directory is read again
+        """
+        script = """add LICENSE.*
+chdir dir
+add **/*
+diradd **/*"""
+        cache = ManifestCache('test.fmcache')
+        items = cache.run(script, replaceDuplicates=1)
+        self.failIf(cache.hit)
+        fmp = FileMapperParser()
+        fmp.replaceDuplicates = 1
+        fmp.runScript(script)
+        self.assertEqual(items, fmp.data.items())
+
+        cache = ManifestCache('test.fmcache')
+        self.assertEqual(cache.run(script, replaceDuplicates=1), items)
+        self.failUnless(cache.hit)
+
+        open('dir/new.txt', 'w').close()
+        os.utime('dir', (self.old + 1, self.old + 1))
+        cache = ManifestCache('test.fmcache')
+        items = cache.run(script, replaceDuplicates=1)
+        self.failIf(cache.hit)
+        # dir, and . which holds the cache file itself
+        self.assertEqual(cache.stats.listed, 2)
+        self.failUnless((os.path.join(os.curdir, 'new.txt'),
+                         os.path.abspath('dir/new.txt'))
+                        in [(d, s) for d, s in items])
+        fmp = FileMapperParser()
+        fmp.replaceDuplicates = 1
+        fmp.runScript(script)
+        self.assertEqual(items, fmp.data.items())
+
+    def test_014watch(self):
+        """A watcher follows files being added, removed and renamed, with
+        inotify or by polling, without running the script again, and ends
+        up where a fresh run would
+        """
+        script = """chdir dir
+exclude *.tmp
+add **/*
+diradd **/*"""
+        def fresh():
+            fmp = FileMapperParser()
+            fmp.replaceDuplicates = 1
+            fmp.runScript(script)
+            items = fmp.data.items()
+            items.sort()
+            return items
+        def snapshot(w):
+            items = w.snapshot()
+            items.sort()
+            return items
+        for polling in (0, 1):
+            w = ManifestWatcher(script, replaceDuplicates=1, polling=polling)
+            try:
+                open('dir/dir2/w%d' % polling, 'w').close()
+                open('dir/dir2/w%d.tmp' % polling, 'w').close()
+                os.rename('dir/dir3/1', 'dir/dir3/2')
+                os.mkdir('dir/dir%d' % (polling + 4))
+                added, removed = w.update(timeout=1)
+                self.failUnless(os.path.join(os.curdir, 'dir2',
+                                             'w%d' % polling) in added)
+                self.failUnless(os.path.join(os.curdir, 'dir%d' %
+                                             (polling + 4), '') in added)
+                self.failUnless(os.path.join(os.curdir, 'dir3', '1')
+                                in removed)
+                self.assertEqual(w.runs, 1)
+                self.assertEqual(snapshot(w), fresh())
+                self.assertEqual(w.update(), ([], []))
+                # a directory with files in it going is run again
+                os.rename('dir/dir2', 'dir/moved')
+                added, removed = w.update(timeout=1)
+                self.failUnless(os.path.join(os.curdir, 'dir2', 'x')
+                                in removed)
+                self.failUnless(os.path.join(os.curdir, 'moved', 'x')
+                                in added)
+                self.assertEqual(w.runs, 2)
+                self.assertEqual(snapshot(w), fresh())
+            finally:
+                w.close()
+            os.rename('dir/moved', 'dir/dir2')
+            os.rename('dir/dir3/2', 'dir/dir3/1')
+            self.backdate()
+
+    def test_015streaming(self):
+        """iterMappings yields what runScript would store, in order, hit by
+        hit as the walk goes
+        """
+        script = """exclude *.pyc
+add LICENSE.*
+diradd program
+chdir test
+add **/*
+chdir ../dir
+diradd **/*
+add **/*"""
+        fmp = FileMapperParser()
+        fmp.runScript(script)
+        it = iterMappings(script)
+        first = it.next()
+        self.assertEqual(first[:2], fmp.data.items()[0])
+        streamed = [first] + list(it)
+        self.assertEqual([(d, s) for d, s, kind in streamed],
+                         fmp.data.items())
+        self.assertEqual(list(iterSources(script)),
+                         list(sourceItems(script)))
+        self.assertEqual(list(iterMappings(script, planned=1)), streamed)
+        self.assertEqual(dict(fmlang.distutilsData(script)),
+                         dict(fmlang.distutilsData(script, cachefile='c')))
+        twice = "add LICENSE.*\nadd LICENSE.inno"
+        self.assertRaises(DuplicateFileException, list, iterMappings(twice))
+        self.assertEqual(len(list(iterMappings(twice, replaceDuplicates=1))),
+                         4)
+        # nothing read is kept, yet one command reads nothing twice
+        streaming = FileMapperParser(retain=0)
+        self.assertEqual(list(streaming.iterScript(script)), streamed)
+        self.assertEqual(streaming.walker.listings, {})
+        self.assertEqual(streaming.walker.held, {})
+        kept = FileMapperParser()
+        kept.onecmd('add **/*')
+        streaming = FileMapperParser(retain=0)
+        streaming.onecmd('add **/*')
+        self.assertEqual(streaming.data.items(), kept.data.items())
+        self.assertEqual(streaming.walker.stats.listed,
+                         kept.walker.stats.listed)
+        # ** can find a directory more than once; it comes out once
+        for glob in ('**/*', '**/dir*', '**/**/*', 'dir/**/*/**'):
+            hits = matches('.', glob)
+            self.assertEqual(len(hits), len(set(hits)))
+            self.assertEqual(gatherHits('.', compileGlob(glob), (),
+                                        StreamingWalker(), os.curdir), hits)
+
+    def test_016tokenizer(self):
+        """splitLine reads lines exactly as shlex does"""
+        def slow(line):
+            cmd, arg = _shlexTokens(line)
+            if arg[:1] in ('"', "'"):
+                arg = arg[1:-1]
+            return cmd, arg
+        lines = ['add *.txt', '  add   "a b"  c', "add ' x y z' # spaces!",
+                 'add a#b', 'add "a#b"', "add a'b c'd", "add 'a'b",
+                 '# add', 'add #', 'add\xffb', '\xff\xff', '"a b" c',
+                 'add a\nb', 'add a#b\nc d', '', ' \t\r']
+        rand = random.Random(14)
+        for n in range(5000):
+            lines.append(''.join([rand.choice(' \t\r\n#\'"ab\xff\x0b*')
+                                  for i in range(rand.randint(0, 10))]))
+        for line in lines:
+            try:
+                expected = slow(line)
+            except ValueError:
+                self.assertRaises(ValueError, splitLine, line)
+            else:
+                self.assertEqual(splitLine(line), expected)
+
+    def test_017scriptCache(self):
+        """Compiled scripts are reused by text and replacements, the least
+        recently used going first, from memory or from disk
+        """
+        parsed = []
+        class CountingParser(FileMapperParser):
+            def parseline(self, line):
+                parsed.append(line)
+                return FileMapperParser.parseline(self, line)
+        saved = fmlang.scriptCache
+        fmlang.scriptCache = fmlang.ScriptCache(2, 'scripts')
+        try:
+            a, b, c = "add a", "add b\nadd c", "add %(x)s"
+            commands = CountingParser().compileScript(b)
+            self.assertEqual(commands, [('add', 'b', 'add b'),
+                                        ('add', 'c', 'add c')])
+            self.assertEqual(CountingParser().compileScript(b), commands)
+            self.assertEqual(len(parsed), 2)
+            self.assertEqual(CountingParser({'x': 'd'}).compileScript(c),
+                             [('add', 'd', 'add d')])
+            self.assertEqual(CountingParser({'x': 'e'}).compileScript(c),
+                             [('add', 'e', 'add e')])
+            self.assertEqual(len(parsed), 4)
+            self.failIf(fmlang.scriptCache.key(b, {}, CountingParser) in
+                        fmlang.scriptCache.scripts)
+            self.assertEqual(len(os.listdir('scripts')), 2)
+            # a new process finds the most recent ones on disk
+            fmlang.scriptCache = fmlang.ScriptCache(2, 'scripts')
+            CountingParser({'x': 'e'}).compileScript(c)
+            self.assertEqual(len(parsed), 4)
+            CountingParser().compileScript(a)
+            self.assertEqual(len(parsed), 5)
+            # another parser's commands are its own
+            class ShoutingParser(FileMapperParser):
+                def parseline(self, line):
+                    return FileMapperParser.parseline(self, line.upper())
+            self.assertEqual(ShoutingParser().compileScript(a),
+                             [('ADD', 'A', 'ADD A')])
+            self.assertEqual(FileMapperParser().compileScript(a),
+                             [('add', 'a', 'add a')])
+            shouting = FileMapperParser()
+            shouting.parseline = ShoutingParser().parseline
+            self.assertEqual(shouting.compileScript(a),
+                             [('ADD', 'A', 'ADD A')])
+            self.assertEqual(FileMapperParser().compileScript(a),
+                             [('add', 'a', 'add a')])
+        finally:
+            fmlang.scriptCache = saved
+
+    def test_018compactManifest(self):
+        """A CompactManifest behaves as an OrderedDict does"""
+        sep = os.sep
+        keys = ['.%sa%sb%d' % (sep, sep, i) for i in range(5)]
+        keys = keys + ['top', '.%sdir%s' % (sep, sep), sep + 'root']
+        pairs = [(k, os.path.abspath(k)) for k in keys]
+        pairs.append(('.%sa%srenamed' % (sep, sep), sep + 'elsewhere'))
+        od, cm = OrderedDict(pairs), CompactManifest(pairs)
+        self.assertEqual(cm.items(), od.items())
+        self.assertEqual(len(cm), len(od))
+        for d in (od, cm):
+            d[keys[1]] = d[keys[1]] # no move
+            d[keys[0]] = 'moved'
+            del d[keys[2]]
+            d['new'] = 'new'
+        self.assertEqual(cm.items(), od.items())
+        self.failIf(keys[2] in cm)
+        self.assertRaises(KeyError, cm.__getitem__, keys[2])
+        self.assertEqual(cm.popitem(), od.popitem())
+        self.assertEqual(cm.copy().items(), od.items())
+        big = CompactManifest([(str(i), str(i)) for i in range(3000)])
+        for i in range(2500):
+            del big[str(i)]
+        self.assertEqual(big.keys(), [str(i) for i in range(2500, 3000)])
+        self.failUnless(len(big._names) < 1000) # dead slots were dropped
+
+        script = "add LICENSE.*\ndiradd program\nchdir test\nadd **/*"
+        fmp = FileMapperParser(compact=1)
+        fmp.replaceDuplicates = 1
+        fmp.runScript(script)
+        plain = FileMapperParser()
+        plain.replaceDuplicates = 1
+        plain.runScript(script)
+        self.assertEqual(fmp.data.items(), plain.data.items())
+        # the compact parser keeps no listings, and stores as it goes
+        self.assertEqual(fmp.walker.listings, {})
+        fmp = FileMapperParser(compact=1)
+        fmp.batchSize = 2
+        fmp.replaceDuplicates = 1
+        fmp.runScript(script)
+        self.assertEqual(fmp.data.items(), plain.data.items())
+        # every duplicate is reported, whichever batch it is in
+        fmp.replaceDuplicates = 0
+        fmp.onecmd('chdir ..')
+        try:
+            fmp.onecmd('add LICENSE.*')
+        except DuplicateFileException, e:
+            self.assertEqual([d for d, s, old in e.items],
+                             [d for d, s in plain.data.items()[:3]])
+        else:
+            self.fail("adding the same files again did not raise")
+        # and nothing the command found is kept
+        last = plain.data.keys()[2]
+        for data in (OrderedDict(), CompactManifest(),
+                     SQLiteManifest('dupes.manifest')):
+            fmp = FileMapperParser()
+            fmp.data = data
+            fmp.batchSize = 1
+            fmp.onecmd('add %s' % last)
+            self.assertRaises(DuplicateFileException, fmp.onecmd,
+                              'add LICENSE.*')
+            self.assertEqual(fmp.data.keys(), [last])
+
+    def test_019sqliteManifest(self):
+        """An SQLiteManifest behaves as an OrderedDict does, and answers
+        questions about what it holds
+        """
+        script = "add LICENSE.*\ndiradd program\nchdir test\nadd **/*"
+        fmp = FileMapperParser()
+        fmp.replaceDuplicates = 1
+        fmp.data = SQLiteManifest('test.manifest')
+        fmp.runScript(script)
+        plain = FileMapperParser()
+        plain.replaceDuplicates = 1
+        plain.runScript(script)
+        sm, od = fmp.data, plain.data
+        try:
+            self.assertEqual(sm.items(), od.items())
+            self.assertEqual(len(sm), len(od))
+            keys = od.keys()
+            for d in (od, sm):
+                d[keys[1]] = d[keys[1]] # no move
+                d[keys[0]] = 'moved'
+                del d[keys[2]]
+                d.update(OrderedDict([(keys[3], 'moved too'),
+                                      (keys[4], d[keys[4]]),
+                                      ('new', 'new')]))
+            self.assertEqual(sm.items(), od.items())
+            self.assertEqual(len(sm), len(od))
+            self.failIf(keys[2] in sm)
+            self.assertRaises(KeyError, sm.__getitem__, keys[2])
+            self.assertEqual(sm.popitem(), od.popitem())
+
+            sep = os.sep
+            sm.clear()
+            sm.update(OrderedDict([
+                ('.%sa%sx' % (sep, sep), 'LICENSE.inno'),
+                ('.%sa%sb%s' % (sep, sep, sep), 'test'),
+                ('.%sa%sb%sy' % (sep, sep, sep), 'LICENSE.inno'),
+                ('.%sab%sz' % (sep, sep), 'LICENSE.process')]))
+            self.assertEqual([d for d, s in sm.filesUnder('.%sa' % sep)],
+                             ['.%sa%sx' % (sep, sep),
+                              '.%sa%sb%sy' % (sep, sep, sep)])
+            self.assertEqual(len(sm.filesUnder('.%sa' % sep, recurse=0)), 1)
+            size = os.path.getsize('LICENSE.inno')
+            self.assertEqual(sm.sizeByDir(),
+                             [('.%sa' % sep, size),
+                              ('.%sa%sb' % (sep, sep), size),
+                              ('.%sab' % sep,
+                               os.path.getsize('LICENSE.process'))])
+            self.assertEqual(sm.duplicates(),
+                             [('LICENSE.inno', ['.%sa%sx' % (sep, sep),
+                                                '.%sa%sb%sy' % (sep, sep,
+                                                                 sep)])])
+            sm.close()
+            again = SQLiteManifest('test.manifest', fresh=0)
+            self.assertEqual(len(again), 4)
+            again.close()
+        finally:
+            sm.close()
+
+    def test_020profile(self):
+        """While profiling, each command's cost is recorded, and the
+        read ahead of a planned script is a row of its own
+        """
+        fmp = FileMapperParser()
+        fmp.replaceDuplicates = 1
+        fmp.onecmd('add LICENSE.*')
+        self.assertEqual(fmp.profile.commands, [])
+        fmp.onecmd('profile on')
+        fmp.onecmd('chdir dir')
+        fmp.onecmd('exclude *dir2*')
+        fmp.onecmd('add **/*')
+        fmp.onecmd('profile off')
+        fmp.onecmd('diradd **/*')
+        lines = [cs.line for cs in fmp.profile.commands]
+        self.assertEqual(lines, ['chdir dir', 'exclude *dir2*', 'add **/*'])
+        chdir, exclude, add = fmp.profile.commands
+        self.assertEqual(exclude.added, 0)
+        self.failUnless(add.added > 0)
+        self.failUnless(add.excluded > 0)
+        self.assertEqual(add.listed, fmp.walker.stats.listed - 1)
+        total = fmp.profile.total()
+        self.assertEqual(total.added, add.added)
+        self.assertEqual(len(fmp.profile.table().splitlines()), 5)
+        # a name looked up by itself costs a probe rather than a listing
+        from inno import dirwalk
+        literal = FileMapperParser()
+        literal.profiling = 1
+        literal.onecmd('add LICENSE.inno')
+        cs = literal.profile.commands[0]
+        if dirwalk.EXACT_NAMES:
+            self.assertEqual((cs.probed, cs.listed), (1, 0))
+        else:
+            self.assertEqual((cs.probed, cs.listed), (0, 1))
+        self.assertEqual(cs.added, 1)
+
+        planned = FileMapperParser()
+        planned.profiling = 1
+        planned.runScript("chdir dir\nadd **/*")
+        first, chdir, add = planned.profile.commands
+        self.assertEqual(first.line,
+                         '(read ahead %s)' % os.path.abspath('dir'))
+        self.assertEqual(first.listed, planned.walker.stats.listed)
+        self.assertEqual(add.listed, 0)
+        self.assertEqual(add.added, len(planned.data))
+
+    def test_021literal(self):
+        """Glob components without wildcards are looked up by name where
+        names are exact, with the same results as matching a listing
+        """
+        from inno import dirwalk
+        script = """add LICENSE.inno
+add dir/dir2/x
+add dir/dir*/1
+add dir/nosuch
+add nosuch/x
+diradd dir/dir3"""
+        wild = script.replace('LICENSE.inno', 'LICENSE.inn[o]')
+        wild = wild.replace('dir/dir2/x', 'dir/dir[2]/x')
+        wild = wild.replace('dir3', 'dir[3]')
+        for planned in (0, 1):
+            fmp = FileMapperParser()
+            fmp.runScript(script, planned)
+            other = FileMapperParser()
+            other.runScript(wild, planned)
+            self.assertEqual(fmp.data.items(), other.data.items())
+            self.assertEqual(len(fmp.data), 5)
+            if dirwalk.EXACT_NAMES:
+                # dir/dir*/1 needs dir listed, and nothing else does
+                self.assertEqual(fmp.walker.listings.keys(),
+                                 [os.path.abspath('dir')])
+                self.failUnless(fmp.walker.stats.probed > 0)
+        # no directory lists '..', so it still matches nothing
+        here = os.path.basename(os.getcwd())
+        self.assertEqual(gatherHits('.', compileGlob(
+            os.path.join(os.pardir, here, 'LICENSE.inno'))), [])
+
+        # a name that was looked up and missing is seen when it turns up
+        script = "add dir/dir3/2"
+        cache = ManifestCache('test.fmcache')
+        self.assertEqual(cache.run(script), [])
+        cache = ManifestCache('test.fmcache')
+        self.assertEqual(cache.run(script), [])
+        self.failUnless(cache.hit)
+        open('dir/dir3/2', 'w').close()
+        os.utime('dir/dir3', (self.old + 1, self.old + 1))
+        cache = ManifestCache('test.fmcache')
+        self.assertEqual(len(cache.run(script)), 1)
+        self.failIf(cache.hit)
+
     def test_004ReplacementDict(self):
         x
     test_004ReplacementDict.todo = "test a fms with %(strings)s in it"
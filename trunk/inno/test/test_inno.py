@@ -1,10 +1,14 @@
+import os
 import sys
+import time
+import shutil
 from cStringIO import StringIO
 
 from twisted.trial import unittest
 from twisted.python import util, zipstream
 
 import inno
+from inno.dedupe import findDuplicates
 
 class InnoTestCase(unittest.TestCase):
     def test_simple(self):
@@ -22,3 +26,413 @@ class InnoTestCase(unittest.TestCase):
         scr.collect('.', exclude_globs=('test.log', ))
         scr.compile()
         sys.stdout = old_stdout
+    def test_dedupe(self):
+        os.mkdir('dd')
+        os.mkdir('dd/en')
+        os.mkdir('dd/de')
+        for name, data in [('dd/en/help.txt', 'same'),
+                           ('dd/de/help.txt', 'same'),
+                           ('dd/de/hilfe.txt', 'same'),
+                           ('dd/en/other.txt', 'diff'),
+                           ('dd/big.dat', 'x' * 100000)]:
+            f = open(name, 'wb')
+            f.write(data)
+            f.close()
+        en, de = os.path.join('dd', 'en'), os.path.join('dd', 'de')
+        self.assertEqual(findDuplicates([os.path.join(en, 'help.txt'),
+                                         os.path.join(en, 'other.txt'),
+                                         os.path.join(de, 'hilfe.txt'),
+                                         os.path.join(de, 'help.txt')]),
+                         [[os.path.join(en, 'help.txt'),
+                           os.path.join(de, 'hilfe.txt'),
+                           os.path.join(de, 'help.txt')]])
+        scr = inno.Script(name="dedupe", display_name="Dedupe",
+                          package_version="1.0", collapse=0)
+        scr.collect('dd')
+        report = scr.dedupe(workers=2)
+        self.assertEqual(report.files(), 2)
+        self.assertEqual(report.bytesSaved(), 8)
+        canonical = report.groups[0][0]
+        out = StringIO()
+        scr.writeScript(out)
+        lines = [l for l in out.getvalue().splitlines()
+                 if l.startswith('Source: "%s"' % canonical)]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(len([l for l in lines if 'DestName' in l]), 1)
+    def test_sources(self):
+        os.mkdir('src')
+        os.mkdir('src/empty')
+        f = open('src/a.txt', 'wb')
+        f.write('abc')
+        f.close()
+        scr = inno.Script(name="sources", display_name="Sources",
+                          package_version="1.0", collapse=0)
+        self.assertRaises(ValueError, scr.watch, 1)
+        scr.collect('src')
+        kinds = dict([(os.path.basename(s.src), s.kind)
+                      for s in scr.sources])
+        self.assertEqual(kinds, {'src': 'dir', 'empty': 'dir',
+                                 'a.txt': 'file'})
+        a = [s for s in scr.sources if s.kind == 'file'][0]
+        self.assertEqual(a.size, 3)
+        self.assertEqual(a.mtime, os.stat('src/a.txt').st_mtime)
+        dest, src = a
+        self.assertEqual(src, os.path.abspath('src/a.txt'))
+        self.assertEqual(a, (dest, src))
+        # another source brings its own size and mtime
+        f = open('b.txt', 'wb')
+        f.write('abcde')
+        f.close()
+        b = a.withSource(os.path.abspath('b.txt'))
+        self.assertEqual((b.dest, b.kind, b.size), (dest, 'file', 5))
+        self.assertEqual(b.mtime, os.stat('b.txt').st_mtime)
+        # writing the script touches nothing on disk
+        saved = os.stat, os.lstat, os.listdir
+        def fail(*args):
+            raise AssertionError("I/O while writing the script")
+        os.stat = os.lstat = os.listdir = fail
+        try:
+            out = StringIO()
+            scr.writeScript(out)
+        finally:
+            os.stat, os.lstat, os.listdir = saved
+        self.assertEqual(len([l for l in out.getvalue().splitlines()
+                              if l.startswith('Source:')]), 1)
+        self.assertEqual(len([l for l in out.getvalue().splitlines()
+                              if l.startswith('Name: "{app}')]), 2)
+    def test_collapse(self):
+        for name in ('tree/a/empty', 'tree/b', 'tree/c'):
+            os.makedirs(name)
+        for name in ('tree/x', 'tree/a/1', 'tree/a/2', 'tree/b/1',
+                     'tree/c/1', 'tree/c/skip.log'):
+            open(name, 'w').close()
+        tree = os.path.abspath('tree')
+        def lines(**kwargs):
+            scr = inno.Script(name="collapse", display_name="Collapse",
+                              package_version="1.0")
+            scr.collect('tree', **kwargs)
+            out = StringIO()
+            scr._section_Files(out)
+            scr._section_Dirs(out)
+            return scr, out.getvalue().splitlines()[1:]
+        scr, out = lines()
+        self.assertEqual(out, ['Source: "%s"; DestDir: "{app}\\."; '
+                               'Flags: ignoreversion recursesubdirs '
+                               'createallsubdirs' % os.path.join(tree, '*'),
+                               '[Dirs]'])
+        self.assertEqual(scr.collapseReport.before, 11)
+        self.assertEqual(scr.collapseReport.after, 1)
+        # without empty directories, they are not created
+        scr, out = lines(empties=0)
+        self.failUnless(out[0].endswith('Flags: ignoreversion recursesubdirs'))
+        # the excluded file keeps c, and so the whole tree, out
+        scr, out = lines(exclude_globs=('*.log',))
+        trees = [os.path.basename(t.src)
+                 for t in scr.collapseReport.subtrees]
+        trees.sort()
+        self.assertEqual(trees, ['a', 'b'])
+        self.failUnless('Source: "%s"; DestDir: "{app}\\%s"; '
+                        'Flags: ignoreversion' % (
+                            os.path.join(tree, 'c', '1'),
+                            os.path.join('.', 'c')) in out)
+        self.assertEqual(len([l for l in out if l.startswith('Source:')]), 4)
+        # ISCC would install a file added since collecting, so the trees
+        # holding it are no longer installed by wildcard
+        scr, out = lines()
+        open(os.path.join('tree', 'b', 'late'), 'w').close()
+        mtime = os.stat(os.path.join('tree', 'b')).st_mtime + 10
+        os.utime(os.path.join('tree', 'b'), (mtime, mtime))
+        built = []
+        def build(iss, compiler):
+            built.append(open(iss).read())
+            open(scr.outputPath(), 'wb').close()
+        scr.compile(build=build)
+        trees = [os.path.basename(t.src)
+                 for t in scr.collapseReport.subtrees]
+        trees.sort()
+        self.assertEqual(trees, ['a', 'c'])
+        self.failIf('late' in built[0])
+        self.failIf('"%s"' % os.path.join(tree, '*') in built[0])
+        self.failUnless(os.path.join(tree, 'a', '*') in built[0])
+        # nor is the directory the build writes to
+        top = os.getcwd()
+        os.chdir('tree')
+        try:
+            scr = inno.Script(name="collapse", display_name="Collapse",
+                              package_version="1.0")
+            scr.collect('.')
+            trees = [os.path.basename(t.src)
+                     for t in scr.collapseReport.subtrees]
+            trees.sort()
+            self.assertEqual(trees, ['a', 'b', 'c'])
+        finally:
+            os.chdir(top)
+    def test_manifestCache(self):
+        for name in ('mc/a', 'mc/b'):
+            os.makedirs(name)
+            for n in range(3):
+                f = open(os.path.join(name, '%d.txt' % n), 'w')
+                f.write(name + str(n))
+                f.close()
+        # directories modified just now are never trusted by the cache
+        old = time.time() - 3600
+        for d, dirs, files in os.walk('mc'):
+            os.utime(d, (old, old))
+        cachefile = os.path.abspath('mc.fmcache')
+        listed = []
+        saved = os.listdir
+        def listdir(d):
+            listed.append(d)
+            return saved(d)
+        os.listdir = listdir
+        try:
+            for hit in (0, 1):
+                del listed[:]
+                scr = inno.Script(name="mc", display_name="Cached",
+                                  package_version="1.0",
+                                  manifest_cache=cachefile)
+                scr.collect('mc')
+                scr.dedupe(workers=1)
+                self.assertEqual(scr.collapseReport.after, 1)
+                # collapsing reads nothing the walk did not
+                if hit:
+                    self.assertEqual(listed, [])
+                else:
+                    self.assertEqual(len(listed), len(set(listed)))
+        finally:
+            os.listdir = saved
+    def test_buildState(self):
+        os.mkdir('bs')
+        for name in ('a.txt', 'b.txt'):
+            f = open(os.path.join('bs', name), 'w')
+            f.write(name)
+            f.close()
+        built = []
+        def fakeBuild(iss, compiler=None):
+            built.append(iss)
+            f = open(scr.outputPath(), 'wb')
+            f.write('installer %d' % len(built))
+            f.close()
+        saved = inno.build
+        inno.build = fakeBuild
+        try:
+            for contentHash in (0, 1):
+                del built[:]
+                scr = inno.Script(name="bs", display_name="Build State",
+                                  package_version="1.0",
+                                  content_hash=contentHash)
+                scr.collect('bs')
+                output = scr.compile()
+                self.assertEqual(output, os.path.abspath('bs-1.0-setup.exe'))
+                self.assertEqual(len(built), 1)
+                self.failIf(scr.buildReport.hit)
+                self.assertEqual(scr.compile(), output)
+                self.assertEqual(len(built), 1)
+                self.failUnless(scr.buildReport.hit)
+                # a new mtime is a change, unless the contents are compared
+                a = os.path.join('bs', 'a.txt')
+                mtime = os.stat(a).st_mtime + 10
+                os.utime(a, (mtime, mtime))
+                scr.collect('bs')
+                scr.compile()
+                self.assertEqual(len(built), 1 + (not contentHash))
+                self.assertEqual(scr.buildReport.hit, contentHash)
+                scr.compile(force=1)
+                self.assertEqual(len(built), 2 + (not contentHash))
+                self.failUnless('forced' in scr.buildReport.reasons)
+                os.remove(output)
+                scr.compile()
+                self.assertEqual(scr.buildReport.reasons, ['no installer'])
+                os.remove('bs.buildstate')
+            # a temporary .iss is whole when iscc runs, and removed after,
+            # even when the build fails
+            temps = []
+            def tempBuild(iss, compiler=None):
+                temps.append((iss, open(iss).read()))
+                raise RuntimeError("iscc failed")
+            inno.build = tempBuild
+            os.remove('bs.iss')
+            self.assertRaises(RuntimeError, scr.compile, temporary=1)
+            iss, text = temps[0]
+            self.failUnless(iss.endswith('.iss'))
+            self.failUnless('[Files]' in text)
+            self.failIf(os.path.exists(iss))
+            self.failIf(os.path.exists('bs.iss'))
+        finally:
+            inno.build = saved
+    def test_artifacts(self):
+        # a compiler that writes the installer an .iss names, and logs runs
+        fake = open('fakeiscc.py', 'w')
+        fake.write('''import sys, os
+options = {}
+for line in open(sys.argv[1]):
+    if '=' in line:
+        k, v = line.strip().split('=', 1)
+        options[k] = v
+out = os.path.join(options['OutputDir'],
+                   options['OutputBaseFilename'] + '.exe')
+open(out, 'wb').write('installer from ' + open(sys.argv[1]).read())
+open(%r, 'a').write(out + '\\n')
+''' % os.path.abspath('compiled.log'))
+        fake.close()
+        cache = os.path.abspath('cache')
+        top = os.getcwd()
+        tools = []
+        def build(agent, version='1.0', **options):
+            # each agent has the compiler installed in its own place, at
+            # its own time
+            tool = os.path.abspath(os.path.join('tools', agent, 'iscc.py'))
+            if not os.path.exists(tool):
+                os.makedirs(os.path.dirname(tool))
+                shutil.copyfile('fakeiscc.py', tool)
+                tools.append(tool)
+                installed = time.time() - 600 * len(tools)
+                os.utime(tool, (installed, installed))
+            compiler = (sys.executable, tool)
+            if not os.path.isdir(agent):
+                os.makedirs(os.path.join(agent, 'src', 'sub'))
+                for name in ('a.txt', os.path.join('sub', 'b.txt')):
+                    f = open(os.path.join(agent, 'src', name), 'w')
+                    f.write(name)
+                    f.close()
+            os.chdir(agent)
+            try:
+                scr = inno.Script(name="art", display_name="Artifacts",
+                                  package_version=version,
+                                  compiler=compiler, artifact_cache=cache,
+                                  **options)
+                scr.collect('src')
+                return scr, open(scr.compile(), 'rb').read()
+            finally:
+                os.chdir(top)
+        def compiled():
+            if not os.path.exists('compiled.log'):
+                return 0
+            return len(open('compiled.log').readlines())
+        old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            scr, first = build('agent1')
+            self.assertEqual(compiled(), 1)
+            self.failIf(scr.buildReport.fetched)
+            self.failUnless('\nOutputDir=%s\n' % os.path.abspath('agent1')
+                            in first)
+            # another checkout somewhere else gets it from the cache
+            scr, second = build(os.path.join('other', 'agent2'))
+            self.assertEqual(compiled(), 1)
+            self.failUnless(scr.buildReport.fetched)
+            self.assertEqual(second, first)
+            # as a copy, so that changing it leaves the cache alone
+            exe = 'art-1.0-setup.exe'
+            fetched = os.path.join('other', 'agent2', exe)
+            entry = [os.path.join(cache, n) for n in os.listdir(cache)
+                     if n.endswith('.exe')][0]
+            self.assertEqual(os.stat(entry).st_mode & 0777, 0444)
+            self.assertEqual(os.stat(fetched).st_mode & 0777, 0644)
+            self.assertNotEqual(os.stat(fetched).st_ino,
+                                os.stat(entry).st_ino)
+            if hasattr(os, 'link'):
+                scr, linked = build(os.path.join('other', 'agent3'),
+                                    artifact_link=1)
+                self.failUnless(scr.buildReport.fetched)
+                self.assertEqual(os.stat(os.path.join('other', 'agent3',
+                                                      exe)).st_ino,
+                                 os.stat(entry).st_ino)
+            # and then has it up to date
+            scr, second = build(os.path.join('other', 'agent2'))
+            self.failUnless(scr.buildReport.hit)
+            # a change in a source is a different installer
+            f = open(os.path.join('agent1', 'src', 'a.txt'), 'w')
+            f.write('changed')
+            f.close()
+            scr, third = build('agent1')
+            self.assertEqual(compiled(), 2)
+            self.failIf(scr.buildReport.fetched)
+            # the least recently used go when the cache is full
+            size = len(third)
+            scr, fourth = build('agent1', '2.0', artifact_cache_size=size * 2)
+            self.assertEqual(compiled(), 3)
+            left = [n for n in os.listdir(cache) if n.endswith('.exe')]
+            self.assertEqual(len(left), 2)
+        finally:
+            sys.stdout = old_stdout
+    def test_atomicFile(self):
+        from inno.atomicfile import writeFile, isTemp
+        os.mkdir('af')
+        target = os.path.join('af', 'state')
+        writeFile(target, lambda f: f.write('one'))
+        writeFile(target, lambda f: f.write('two'), 0444)
+        self.assertEqual(open(target).read(), 'two')
+        self.assertEqual(os.stat(target).st_mode & 0777, 0444)
+        def fail(f):
+            f.write('half')
+            raise ValueError
+        self.assertRaises(ValueError, writeFile, target, fail)
+        self.assertEqual(open(target).read(), 'two')
+        # no temporary file is left behind, and none would be mistaken
+        self.assertEqual(os.listdir('af'), ['state'])
+        self.failUnless(isTemp('state.x1y2.tmp', target))
+        self.failIf(isTemp('statefile.tmp', target))
+    def test_buildMany(self):
+        from inno.runner import main, summarize
+        # a compiler that takes half a second and logs when it ran, fails
+        # on request, and can write more than a pipe holds to stderr
+        fake = open('slowiscc.py', 'w')
+        fake.write('''import sys, time
+start = time.time()
+time.sleep(0.5)
+text = open(sys.argv[1]).read()
+print 'compiled', sys.argv[1]
+if 'LOUD' in text:
+    sys.stderr.write('warning\\n' * 100000)
+open(%r, 'a').write('%%r %%r\\n' %% (start, time.time()))
+if 'FAIL' in text:
+    sys.stderr.write('error in ' + sys.argv[1] + '\\n')
+    sys.exit(2)
+''' % os.path.abspath('runs.log'))
+        fake.close()
+        compiler = (sys.executable, os.path.abspath('slowiscc.py'))
+        names = []
+        for n in range(4):
+            names.append('s%d.iss' % n)
+            f = open(names[-1], 'w')
+            f.write({2: 'FAIL', 3: 'LOUD'}.get(n, 'fine'))
+            f.close()
+        os.mkdir('many')
+        open(os.path.join('many', 'x.txt'), 'w').close()
+        scr = inno.Script(name="many", display_name="Many",
+                          package_version="1.0", compiler=compiler)
+        scr.collect('many')
+        results = inno.buildMany(names + [scr], jobs=5, compiler=compiler)
+        # some of the compilers ran at the same time
+        runs = [map(float, line.split()) for line in open('runs.log')]
+        runs.sort()
+        self.assertEqual(len(runs), 5)
+        overlapped = 0
+        for (start, end), (nextStart, nextEnd) in zip(runs, runs[1:]):
+            if nextStart < end:
+                overlapped = 1
+        self.failUnless(overlapped, runs)
+        self.assertEqual([r.name for r in results], names + ['many'])
+        self.assertEqual([r.failed() for r in results],
+                         [0, 0, 1, 0, 0])
+        self.assertEqual(results[0].output.strip(), 'compiled s0.iss')
+        self.failUnless('error in s2.iss' in results[2].output)
+        self.failUnless('status' in results[2].error)
+        self.assertEqual(results[3].output.count('warning'), 100000)
+        self.assertEqual(results[4].installer, scr.outputPath())
+        self.failUnless(results[4].output.startswith('compiled many.iss'))
+        self.failIf(results[4].report.hit)
+        report = summarize(results)
+        self.failUnless(report.endswith('4 succeeded, 1 failed, %.1fs of work'
+                                        % sum([r.seconds for r in results])))
+        old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEqual(main(['-j', '2', '-c', ' '.join(compiler),
+                                   's0.iss', 's1.iss']), 0)
+            self.assertEqual(main(['-c', ' '.join(compiler), 's2.iss']), 1)
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+        self.failUnless('error in s2.iss' in out)
@@ -0,0 +1,460 @@
+"""Keep the result of an fmscript current while the tree changes.
+
+A ManifestWatcher runs an fmscript once and then watches every directory
+the run read.  On Linux it asks inotify (through ctypes) to report
+entries being created, deleted and renamed; elsewhere, or when inotify
+cannot be had, it polls the directories' mtimes.  Either way, when a
+directory changes only that directory is read again, and comparing the
+new listing with the old one tells which entries came and went (a
+rename is one of each).
+
+Each of those entries is put through the script's add and diradd
+commands on its own, with the globs and exclusions they were compiled
+with, and the manifest gains or loses just the items it makes.  Only
+when that cannot be sure of the answer is the whole script run again,
+over the listings already in memory: when a directory the globs look
+into comes with entries in it or goes, when a chdir target comes or
+goes, or when a destination is claimed twice.  Either way the manifest
+holds what a fresh run would make, though items added since the last
+full run come at the end rather than where a fresh run would put them.
+"""
+import os
+import time
+import errno
+import select
+import struct
+
+from inno.dirwalk import DirWalker, DirEntry, FILE, DIR, EXACT_NAMES
+from inno.dirwalk import RACY_SECONDS
+from inno.dirwalk import _prefix
+from inno.workers import WorkerPool
+from inno.fmlang import FileMapperParser, iterHits
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# inotify event bits, from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+
+class InotifyBackend:
+    """Reports changed directories using Linux inotify"""
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        if ctypes is None:
+            raise OSError(errno.ENOSYS, "ctypes is not available")
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        try:
+            self._add = libc.inotify_add_watch
+            self._rm = libc.inotify_rm_watch
+            self.fd = libc.inotify_init()
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.dirs = {}  # dir: watch descriptor
+        self.wds = {}   # watch descriptor: dir
+        self.changed = {}
+
+    def add(self, dirpath, mtime):
+        """Watch dirpath, which was read when its mtime was mtime"""
+        if dirpath in self.dirs:
+            return
+        wd = self._add(self.fd, dirpath, WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), dirpath)
+        self.dirs[dirpath] = wd
+        self.wds[wd] = dirpath
+        # anything that happened between the read and the watch
+        try:
+            if os.stat(dirpath).st_mtime != mtime:
+                self.changed[dirpath] = 1
+        except OSError:
+            self.changed[dirpath] = 1
+
+    def remove(self, dirpath):
+        wd = self.dirs.pop(dirpath, None)
+        if wd is not None:
+            del self.wds[wd]
+            self._rm(self.fd, wd)
+
+    def changes(self, timeout=0):
+        """Return the directories that changed, waiting up to timeout
+        seconds for the first, or None if inotify lost track and anything
+        may have changed
+        """
+        overflow = 0
+        wait = timeout
+        while select.select([self.fd], [], [], wait)[0]:
+            buf = os.read(self.fd, 65536)
+            wait = 0
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, size = self._event.unpack_from(buf, pos)
+                pos = pos + self._event.size + size
+                if mask & IN_Q_OVERFLOW:
+                    overflow = 1
+                    continue
+                dirpath = self.wds.get(wd)
+                if dirpath is None:
+                    continue
+                self.changed[dirpath] = 1
+                if mask & IN_IGNORED:
+                    # the kernel dropped the watch: the directory is gone
+                    del self.wds[wd]
+                    del self.dirs[dirpath]
+        changed, self.changed = self.changed.keys(), {}
+        if overflow:
+            return None
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingBackend:
+    """Reports changed directories by comparing their mtimes"""
+    def __init__(self):
+        self.dirs = {}  # dir: mtime, or None to read it again regardless
+
+    def add(self, dirpath, mtime):
+        """Watch dirpath, which was read when its mtime was mtime"""
+        if mtime is not None and mtime > time.time() - RACY_SECONDS:
+            mtime = None # read it again until it has been quiet a while
+        self.dirs[dirpath] = mtime
+
+    def remove(self, dirpath):
+        self.dirs.pop(dirpath, None)
+
+    def changes(self, timeout=0):
+        """Return the directories that changed, sleeping up to timeout
+        seconds while there are none
+        """
+        end = time.time() + timeout
+        while 1:
+            changed = []
+            for dirpath, mtime in self.dirs.iteritems():
+                try:
+                    if os.stat(dirpath).st_mtime == mtime:
+                        continue
+                except OSError:
+                    pass
+                changed.append(dirpath)
+            left = end - time.time()
+            if changed or left <= 0:
+                return changed
+            time.sleep(min(left, 1.0))
+
+    def close(self):
+        self.dirs = {}
+
+
+def newBackend(polling=0):
+    """An InotifyBackend where possible, unless polling, else a
+    PollingBackend
+    """
+    if not polling:
+        try:
+            return InotifyBackend()
+        except OSError:
+            pass
+    return PollingBackend()
+
+
+class _PathWalker(DirWalker):
+    """A DirWalker that knows of one entry and the directories leading to
+    it, and of nothing else, so that walking a glob through it finds just
+    the hits that entry makes in a walk of the whole tree.  descended
+    says whether the walk looked inside the entry.
+    """
+    def __init__(self, entry):
+        DirWalker.__init__(self)
+        self.target = entry.path
+        self.descended = 0
+        self.children = {} # directory: the entry below it on the way
+        child, d = entry, entry.path
+        while 1:
+            parent, name = os.path.split(d)
+            if not name:
+                break
+            self.children[parent] = child
+            child = DirEntry(os.path.basename(parent), parent, self.stats,
+                             DIR)
+            d = parent
+
+    def listdir(self, dirpath):
+        if dirpath == self.target:
+            self.descended = 1
+        child = self.children.get(dirpath)
+        if child is None:
+            return []
+        return [child]
+
+    def lookup(self, dirpath, name):
+        if dirpath == self.target:
+            self.descended = 1
+        child = self.children.get(dirpath)
+        if child is None:
+            return None
+        if child.name == name or (not EXACT_NAMES and
+                                  os.path.normcase(child.name) ==
+                                  os.path.normcase(name)):
+            return child
+        return None
+
+
+def entryHits(steps, entry):
+    """Return the (destination, source) items the DirEntry entry makes
+    under steps, the (command, root, GlobMatcher, ExclusionMatcher) list
+    of FileMapperParser.followScript(), and whether any of them looks
+    inside it
+    """
+    walker = _PathWalker(entry)
+    found = []
+    for cmd, root, glob, excluded in steps:
+        for dest, src, kind in iterHits(root, glob, excluded, walker,
+                                        os.curdir):
+            if src != entry.path:
+                continue
+            if cmd == 'add':
+                if kind != DIR:
+                    found.append((dest, src))
+            elif kind != FILE:
+                found.append((dest + os.sep, src))
+    return found, walker.descended
+
+
+def _changes(old, new):
+    """The (entry, created) changes from the listing old to new: entries
+    whose name went, or whose kind changed, and those that came.  An
+    entry whose kind was never asked for mattered to no glob.
+    """
+    oldNames = dict([(e.name, e) for e in old])
+    newNames = dict([(e.name, e) for e in new])
+    changes = []
+    for e in old:
+        n = newNames.get(e.name)
+        if n is None or (e.knownKind() is not None and
+                         n.kind() != e.knownKind()):
+            changes.append((e, 0))
+    for e in new:
+        o = oldNames.get(e.name)
+        if o is None or (o.knownKind() is not None and
+                         e.kind() != o.knownKind()):
+            changes.append((e, 1))
+    return changes
+
+
+class ManifestWatcher:
+    """Runs fmscript and keeps its result current.  Call update() (or
+    snapshot(), which calls it) to bring the result up to date with the
+    tree; data holds the result between calls, and runs counts the
+    times the whole script was run.
+    >>> w = ManifestWatcher("chdir src\\nadd **/*")
+    >>> w.snapshot() # [(destination, source), ...]
+    """
+    def __init__(self, fmscript, replacements={}, replaceDuplicates=0,
+                 workers=0, polling=0):
+        self.fmscript = fmscript
+        self.replacements = replacements
+        self.replaceDuplicates = replaceDuplicates
+        self.polling = polling
+        pool = None
+        if workers > 1:
+            pool = WorkerPool(workers)
+        self.walker = DirWalker(pool)
+        self.walker.mtimes = {}
+        self.backend = newBackend(polling)
+        self.data = None
+        self.steps = []
+        self.runs = 0
+        self.evaluate()
+
+    def evaluate(self):
+        """Run the script over the listings the walker has, reading only
+        directories it lacks, and watch whatever was read.  Return the
+        destinations (added, removed) since the last run.
+        """
+        fmp = FileMapperParser(self.replacements)
+        fmp.replaceDuplicates = self.replaceDuplicates
+        fmp.walker = self.walker
+        steps = fmp.followScript(fmp.compileScript(self.fmscript))
+        fmp.runScript(self.fmscript)
+        self.runs = self.runs + 1
+        self.steps = steps
+        old = self.data or {}
+        new = fmp.data
+        added = [d for d in new if d not in old]
+        removed = [d for d in old if d not in new]
+        self.data = new
+        self._watch()
+        return added, removed
+
+    def _watch(self):
+        consulted = set(self.walker.consulted())
+        mtimes = self.walker.mtimes
+        for dirpath in self.backend.dirs.keys():
+            if dirpath not in consulted:
+                self.backend.remove(dirpath)
+        for dirpath in consulted:
+            try:
+                self.backend.add(dirpath, mtimes.get(dirpath))
+            except OSError:
+                # out of inotify watches, most likely
+                self.backend.close()
+                self.backend = PollingBackend()
+                return self._watch()
+
+    def update(self, timeout=0):
+        """Read again the directories that changed, waiting up to timeout
+        seconds for a change, and bring data up to date.  Return the
+        destinations (added, removed).
+        """
+        changed = self.backend.changes(timeout)
+        if changed is None:
+            self.walker.forget()
+        elif not changed:
+            return [], []
+        else:
+            undo = []
+            added, removed = [], []
+            if self._apply(changed, undo, added, removed):
+                self._watch()
+                both = set(added) & set(removed)
+                return ([d for d in added if d not in both],
+                        [d for d in removed if d not in both])
+            # put data back as it was, for evaluate() to compare with
+            undo.reverse()
+            for dest, src in undo:
+                if src is None:
+                    del self.data[dest]
+                else:
+                    self.data[dest] = src
+        return self.evaluate()
+
+    def _apply(self, changed, undo, added, removed):
+        """Read the changed directories again and apply what came and went
+        in them to data, noting each change in undo as (destination,
+        source it had or None) and in added or removed.  Returns false if
+        the script has to be run again instead.
+        """
+        walker = self.walker
+        before = []
+        for dirpath in changed:
+            before.append((dirpath, walker.listings.get(dirpath),
+                           walker.probes.get(dirpath)))
+            walker.forget(dirpath, recurse=0)
+        changes = []
+        for dirpath, listing, probes in before:
+            try:
+                if listing is not None:
+                    changes.extend(_changes(listing, walker.listdir(dirpath)))
+                elif probes is not None:
+                    # only these names were ever looked up in it
+                    for name, entry in probes.items():
+                        new = walker.lookup(dirpath, name)
+                        changes.extend(_changes(filter(None, [entry]),
+                                                filter(None, [new])))
+            except OSError:
+                return 0 # the directory itself went
+        # what went first, so that a rename does not look like a clash
+        for created in (0, 1):
+            for entry, c in changes:
+                if c == created and not self._change(entry, created, undo,
+                                                     added, removed):
+                    return 0
+        return 1
+
+    def _change(self, entry, created, undo, added, removed):
+        """Apply one entry coming or going to data; see _apply()"""
+        if created:
+            kind = entry.kind()
+        else:
+            kind = entry.knownKind()
+            if kind is None:
+                return 1
+        path = entry.path
+        below = _prefix(path)
+        for cmd, root, glob, excluded in self.steps:
+            if root == path or root.startswith(below):
+                return 0 # a chdir target came or went
+        if not created and kind == DIR:
+            if (self.walker.listings.get(path) or
+                [e for e in self.walker.probes.get(path, {}).values() if e]):
+                return 0 # what was in it mattered
+            self.walker.forget(path)
+        hits, descended = entryHits(self.steps, entry)
+        if created and descended:
+            # the globs look inside it, so what is in it counts too
+            try:
+                if self.walker.listdir(path):
+                    return 0
+            except OSError:
+                return 0
+        data = self.data
+        if created:
+            dests = [dest for dest, src in hits]
+            if len(set(dests)) != len(dests):
+                return 0
+            for dest in dests:
+                if dest in data:
+                    return 0
+            for dest, src in hits:
+                data[dest] = src
+                undo.append((dest, None))
+                added.append(dest)
+        else:
+            for dest, src in hits:
+                if data.get(dest) != src:
+                    continue # another source won it
+                if self.replaceDuplicates and self._otherSource(dest, src):
+                    return 0
+                del data[dest]
+                undo.append((dest, src))
+                removed.append(dest)
+        return 1
+
+    def _otherSource(self, dest, src):
+        """Whether some other entry may map to dest, now that src no longer
+        does, as one that lost it to src under replaceDuplicates
+        """
+        rel = dest[len(os.curdir + os.sep):]
+        if rel[-1:] == os.sep:
+            rel = rel[:-1]
+        for cmd, root, glob, excluded in self.steps:
+            other = os.path.join(root, rel)
+            if other != src and os.path.lexists(other):
+                return 1
+        return 0
+
+    def snapshot(self):
+        """The current (destination, source) items, as
+        FileMapperParser.data.items() would have them, except that items
+        added since the last full run come last
+        """
+        self.update()
+        return self.data.items()
+
+    def close(self):
+        """Stop watching"""
+        self.backend.close()
@@ -0,0 +1,76 @@
+"""A small pool of worker threads, for overlapping slow I/O"""
+import sys
+import threading
+from collections import deque
+
+
+class Job:
+    """The pending result of a call handed to a WorkerPool"""
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.value = None
+        self.excinfo = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.excinfo = sys.exc_info()
+        self.done.set()
+
+    def result(self):
+        """Wait for the call to finish and return what it returned, or
+        raise what it raised
+        """
+        self.done.wait()
+        if self.excinfo is not None:
+            raise self.excinfo[0], self.excinfo[1], self.excinfo[2]
+        return self.value
+
+
+class WorkerPool:
+    """Runs calls in up to size threads.  Threads are started as work
+    arrives and go away as soon as there is none left, so a pool costs
+    nothing while unused and never needs shutting down.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.jobs = deque()
+        self.lock = threading.Lock()
+        self.threads = 0
+
+    def submit(self, func, *args):
+        """Call func(*args) in a worker thread; return its Job"""
+        job = Job(func, args)
+        self.lock.acquire()
+        try:
+            self.jobs.append(job)
+            if self.threads < self.size:
+                self.threads = self.threads + 1
+                t = threading.Thread(target=self._work)
+                t.setDaemon(1)
+                t.start()
+        finally:
+            self.lock.release()
+        return job
+
+    def map(self, func, items):
+        """Like the builtin map(), but the calls run in the pool"""
+        jobs = [self.submit(func, item) for item in items]
+        return [job.result() for job in jobs]
+
+    def _work(self):
+        while 1:
+            # submit() queues under the lock, so no job can slip in
+            # between finding the queue empty and giving up
+            self.lock.acquire()
+            try:
+                if not self.jobs:
+                    self.threads = self.threads - 1
+                    return
+                job = self.jobs.popleft()
+            finally:
+                self.lock.release()
+            job.run()